@@ -19,7 +19,10 @@ from ampm.repo.base import ArtifactQuery, AmbiguousQueryError, RepoGroup, QueryN
 from ampm.repo.local import LOCAL_REPO
 from ampm import __version__
 from ampm.repo.nfs import NfsRepo
-from ampm.utils import _calc_dir_size, randbytes, hash_local_file, remove_atexit
+from ampm.utils import _calc_dir_size, randbytes, hash_local_file, remove_atexit, HashingWriter
+
+# The compressed output is written in small pieces, buffer them so they reach the disk in big writes
+COMPRESS_BUFFER_SIZE = 1024 * 1024
 
 
 class OrderedGroup(click.Group):
@@ -343,14 +346,33 @@ def upload(
         If LOCAL_PATH is unspecified, assume already it's uploaded to value of `--remote-path`
     """
 
+    remote_repo = ArtifactRepo.by_uri(ctx.obj['server'])
+    meta = upload_artifact(remote_repo, local_path, type, name, description, compressed, remote_path, attr, env)
+
+    print(f'{meta.type}:{meta.hash}')
+
+
+def upload_artifact(
+        remote_repo: ArtifactRepo,
+        local_path: Optional[Path],
+        type: str,
+        name: Optional[str],
+        description: Optional[str],
+        compressed: bool,
+        remote_path: Optional[str],
+        attr: Dict[str, str],
+        env: Dict[str, str],
+) -> ArtifactMetadata:
+    """
+        Implementation of `upload`, usable without going through the command line parser.
+    """
+
     verify_type(type)
     verify_attributes(attr)
 
     if local_path is None and remote_path is None:
         raise click.BadParameter('Must specify either LOCAL_PATH or --remote-path')
 
-    remote_repo = ArtifactRepo.by_uri(ctx.obj['server'])
-
     tmp_file_to_remove = None
 
     if local_path is not None:
@@ -370,8 +392,10 @@ def upload(
                     desc=f"Compressing {local_path.name}"
                 )
                 size_left = total_size
-                with tmp_file.open('wb') as f:
-                    with tarfile.open(fileobj=f, mode='w:gz', compresslevel=6) as tar:
+                with tmp_file.open('wb', buffering=COMPRESS_BUFFER_SIZE) as out_file:
+                    # Hash while compressing, instead of reading the result again
+                    out_file = HashingWriter(out_file)
+                    with tarfile.open(fileobj=out_file, mode='w:gz', compresslevel=6) as tar:
                         for path in local_path.rglob('*'):
                             if path.is_file():
                                 tar.add(path, arcname=path.relative_to(local_path))
@@ -380,7 +404,7 @@ def upload(
                             elif path.is_dir():
                                 tar.add(path, arcname=path.relative_to(local_path), recursive=False)
 
-                artifact_hash = hash_local_file(tmp_file)
+                artifact_hash = out_file.hexdigest()
                 bar.close()
                 local_path = tmp_file
             else:
@@ -399,17 +423,21 @@ def upload(
                     desc=f"Compressing {local_path.name}"
                 )
                 size_left = total_size
-                with gzip.GzipFile(tmp_file, mode='wb') as zbuffer:
-                    with local_path.open('rb') as f:
+                with tmp_file.open('wb', buffering=COMPRESS_BUFFER_SIZE) as out_file:
+                    # Hash while compressing, instead of reading the result again
+                    out_file = HashingWriter(out_file)
+                    with gzip.GzipFile(fileobj=out_file, mode='wb', compresslevel=6) as zbuffer, local_path.open('rb') as f:
+                        # Reused for every chunk, instead of allocating a new `bytes` each time
+                        buf = memoryview(bytearray(1024*1024))
                         while True:
-                            data = f.read(1024*1024)
-                            if len(data) == 0:
+                            length = f.readinto(buf)
+                            if length == 0:
                                 break
-                            zbuffer.write(data)
+                            zbuffer.write(buf[:length])
                             bar.update(min(1024, size_left))
                             size_left -= 1024
 
-                artifact_hash = hash_local_file(tmp_file)
+                artifact_hash = out_file.hexdigest()
                 bar.close()
                 local_path = tmp_file
             else:
@@ -454,11 +482,88 @@ def upload(
 
     remote_repo.upload(meta, local_path)
 
-    print(f'{meta.type}:{meta.hash}')
-
     if tmp_file_to_remove is not None:
         tmp_file_to_remove.unlink(missing_ok=True)
 
+    return meta
+
+
+_MANIFEST_KEYS = {'local_path', 'type', 'name', 'description', 'compressed', 'remote_path', 'attr', 'env'}
+
+
+def _validate_manifest_types(line_num: int, record: dict):
+    if not isinstance(record['type'], str):
+        raise click.BadParameter(f'Line {line_num}: "type" must be a string')
+    for key in ('local_path', 'name', 'description', 'remote_path'):
+        if record.get(key) is not None and not isinstance(record[key], str):
+            raise click.BadParameter(f'Line {line_num}: "{key}" must be a string')
+    if not isinstance(record.get('compressed', True), bool):
+        raise click.BadParameter(f'Line {line_num}: "compressed" must be true or false')
+    for key in ('attr', 'env'):
+        value = record.get(key, {})
+        if not isinstance(value, dict) or not all(isinstance(v, str) for v in value.values()):
+            raise click.BadParameter(
+                f'Line {line_num}: "{key}" must be an object of strings, e.g. {{"arch": "x86_64"}}'
+            )
+
+
+@cli.command(name='upload-many')
+@click.option(
+    '--manifest',
+    help='JSON-lines file with one artifact per line, `-` for stdin',
+    type=click.File('r'),
+    required=True
+)
+@click.pass_context
+def upload_many(ctx: click.Context, manifest):
+    """
+        Upload many artifacts in one go, printing each one's identifier as it's uploaded.
+
+        Every line of the manifest is an object with the same fields as the options of `upload`, e.g.:
+
+        \b
+        {"local_path": "foobar.txt", "type": "foobar", "compressed": false, "attr": {"arch": "x86_64"}}
+    """
+
+    remote_repo = ArtifactRepo.by_uri(ctx.obj['server'])
+
+    # Validate the whole manifest first, so a bad line doesn't leave it half uploaded
+    records = []
+    for line_num, line in enumerate(manifest, start=1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError as e:
+            raise click.BadParameter(f'Line {line_num} is not valid JSON: {e}')
+        if not isinstance(record, dict) or 'type' not in record or not _MANIFEST_KEYS.issuperset(record.keys()):
+            raise click.BadParameter(
+                f'Line {line_num} must be an object with a "type", and any of: {", ".join(sorted(_MANIFEST_KEYS))}'
+            )
+        _validate_manifest_types(line_num, record)
+
+        local_path = record.get('local_path')
+        if local_path is not None:
+            local_path = Path(local_path)
+            if not local_path.exists():
+                raise click.BadParameter(f'Line {line_num}: Path does not exist: {local_path}')
+        records.append((local_path, record))
+
+    for local_path, record in records:
+        meta = upload_artifact(
+            remote_repo,
+            local_path,
+            record['type'],
+            record.get('name'),
+            record.get('description'),
+            record.get('compressed', True),
+            record.get('remote_path'),
+            record.get('attr', {}),
+            record.get('env', {}),
+        )
+
+        print(f'{meta.type}:{meta.hash}', flush=True)
+
 
 @cli.command()
 @click.argument('artifact', type=str)
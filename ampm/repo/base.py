@@ -1,4 +1,5 @@
 import base64
+import copy
 import dataclasses
 import datetime
 import hashlib
@@ -19,7 +20,8 @@ except FileNotFoundError:
 
 
 def hash_buffer(buffer) -> str:
-    return base64.b32encode(hashlib.sha256(buffer).digest()).decode("utf-8")[:32]
+    # 20 bytes are exactly 32 base32 characters, the same as encoding the whole digest and truncating it
+    return base64.b32encode(hashlib.sha256(buffer).digest()[:20]).decode("ascii")
 
 
 @dataclasses.dataclass(frozen=True)
@@ -36,6 +38,7 @@ class ArtifactMetadata:
     mutable: Dict[str, any]
 
     def to_dict(self, with_mutable: bool) -> Dict:
+        # Always a fresh copy, callers may change it without affecting `hash` or `to_toml`
         result = {
             "artifact": {
                 "name": self.name,
@@ -43,8 +46,8 @@ class ArtifactMetadata:
                 "pubdate": self.pubdate.isoformat(),
                 "type": self.type,
             },
-            "attributes": self.attributes,
-            "env": self.env,
+            "attributes": dict(self.attributes),
+            "env": dict(self.env),
             "path": {
                 "type": self.path_type,
             },
@@ -54,7 +57,7 @@ class ArtifactMetadata:
         if self.path_hash:
             result["path"]["hash"] = self.path_hash
         if with_mutable:
-            result["mutable"] = self.mutable
+            result["mutable"] = copy.deepcopy(self.mutable)
         return result
 
     @staticmethod
@@ -74,9 +77,21 @@ class ArtifactMetadata:
             mutable=data.get("mutable", {}),
         )
 
+    @cached_property
+    def _serialized_toml(self) -> bytes:
+        # Only the serialized bytes are cached, they can't be changed by whoever uses them
+        return toml.dumps(self.to_dict(with_mutable=False)).encode("utf-8")
+
+    def to_toml(self, with_mutable: bool) -> bytes:
+        if not with_mutable:
+            return self._serialized_toml
+        # `mutable` may be changed in-place (e.g. when editing), so only the immutable part is cached.
+        # This is byte-for-byte what `toml.dumps(self.to_dict(with_mutable=True))` would output.
+        return self._serialized_toml + b"\n" + toml.dumps({"mutable": self.mutable}).encode("utf-8")
+
     @cached_property
     def hash(self):
-        return hash_buffer(toml.dumps(self.to_dict(with_mutable=False)).encode("utf-8")).lower()
+        return hash_buffer(self._serialized_toml).lower()
 
     @property
     def path_suffix(self):
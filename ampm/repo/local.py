@@ -1,12 +1,22 @@
 import collections
 import shlex
-import toml
-from functools import cmp_to_key
+from functools import cmp_to_key, lru_cache
 from pathlib import Path
 from typing import Iterable, Optional
 from ampm.attribute_comparators import COMPARATORS
 from ampm.repo.base import ArtifactRepo, ArtifactQuery, ArtifactMetadata, QueryNotFoundError, AmbiguousComparisonError
-from ampm.utils import LockFile
+from ampm.utils import LockFile, load_toml
+
+
+@lru_cache(maxsize=1024)
+def _parse_metadata(path: Path, _inode: int, _mtime_ns: int, _size: int) -> ArtifactMetadata:
+    # The file's identity is part of the key, so a replaced or rewritten file is parsed again
+    return ArtifactMetadata.from_dict(load_toml(path))
+
+
+def _load_metadata(path: Path) -> ArtifactMetadata:
+    stat = path.stat()
+    return _parse_metadata(path, stat.st_ino, stat.st_mtime_ns, stat.st_size)
 
 
 class LocalRepo(ArtifactRepo):
@@ -26,7 +36,7 @@ class LocalRepo(ArtifactRepo):
 
     def _lookup_by_type(self, artifact_type: str) -> Iterable[ArtifactMetadata]:
         for metadata_path in self.metadata_path_of(artifact_type, None, '').glob('**/*.toml'):
-            yield ArtifactMetadata.from_dict(toml.load(metadata_path))
+            yield _load_metadata(metadata_path)
 
     def lockfile_for_artifact(self, metadata: ArtifactMetadata) -> LockFile:
         return LockFile(self.artifact_base_path_of(metadata, '.lock'), f'artifact {metadata.type}:{metadata.hash}',)
@@ -169,7 +179,7 @@ class LocalRepo(ArtifactRepo):
         raise NotImplementedError()
 
     def metadata_of(self, artifact_type: str, artifact_hash: str) -> ArtifactMetadata:
-        return ArtifactMetadata.from_dict(toml.load(self.metadata_path_of(artifact_type, artifact_hash)))
+        return _load_metadata(self.metadata_path_of(artifact_type, artifact_hash))
 
     def metadata_path_of(self, artifact_type: str, artifact_hash: Optional[str], suffix='.toml') -> Path:
         return self.path / 'metadata' / artifact_type.strip('/') / ((artifact_hash or '') + suffix)
@@ -191,7 +201,7 @@ class LocalRepo(ArtifactRepo):
 
     def format_env_file(self, metadata: ArtifactMetadata) -> str:
         base_dir = self.artifact_path_of(metadata)
-        env = metadata.mutable.get('env', {})
+        env = dict(metadata.mutable.get('env', {}))
         env.update(metadata.env)
         return '\n'.join(
             f'export {shlex.quote(k)}={shlex.quote(v.replace("${BASE_DIR}", str(base_dir)))}'
@@ -1,34 +1,63 @@
+import atexit
+import concurrent.futures
 import contextlib
+import copy
+import dataclasses
+import errno
+import fcntl
+import functools
 import hashlib
 import os
+import queue
 import subprocess
 import sys
 import re
 import shutil
+import stat
 import threading
+import time
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from math import ceil
 from pathlib import Path
-from typing import List, Iterable, ContextManager, Optional, Dict
+from typing import List, Iterable, ContextManager, Optional, Dict, Tuple, Set, Any
 
-import toml
 import tqdm
 from pyNfsClient import (Portmap, Mount, NFSv3, MNT3_OK, NFS_PROGRAM,
-                         NFS_V3, NFS3_OK, UNCHECKED, NFS3ERR_EXIST, UNSTABLE, NFS3ERR_NOTDIR, NFS3ERR_ISDIR, NFSSTAT3, NF3DIR, NFS3ERR_NOTSUPP)
+                         NFS_V3, NFS3_OK, UNCHECKED, NFS3ERR_EXIST, UNSTABLE, NFS3ERR_NOTDIR, NFS3ERR_ISDIR, NFSSTAT3, NF3DIR, NFS3ERR_NOTSUPP,
+                         NFS3ERR_NOENT, NFS3ERR_STALE, NFS3ERR_BADHANDLE, NF3LNK)
 
 from ampm.repo.base import ArtifactRepo, ArtifactMetadata, ArtifactQuery, QueryNotFoundError, ARTIFACT_TYPES, \
     ArtifactCorruptedError, NiceTrySagi
 from ampm.repo.local import LOCAL_REPO
-from ampm.utils import _calc_dir_size, remove_atexit, LockFile
+from ampm.utils import _calc_dir_size, remove_atexit, randbytes, LockFile, HASH_CHUNK_SIZE, load_toml
 
-DEFAULT_CHUNK_SIZE = int(os.environ.get("AMPM_CHUNK_SIZE", str(1024 * 32)))
+DEFAULT_CHUNK_SIZE = int(os.environ.get("AMPM_CHUNK_SIZE", str(1024 * 1024)))
 NFS_OP_TIMEOUT_SEC = 16
-
-
-def _common_prefix(iter1, iter2):
-    for (a, b) in zip(iter1, iter2):
-        if a != b:
-            break
-        yield a
+FH_CACHE_SIZE = 1024
+FH_CACHE_TTL_SEC = 60
+# Like the kernel's `acregmin`, file attributes (e.g. size) go stale much faster than directory handles
+FILE_ATTR_CACHE_TTL_SEC = 3
+NEGATIVE_LOOKUP_CACHE_TTL_SEC = 30
+# Servers may keep mtimes in whole seconds, so a directory changed this recently may still change without its mtime
+NEGATIVE_LOOKUP_MIN_DIR_AGE_SEC = 2
+PREFETCH_DEPTH = 8
+READ_PIPELINE_DEPTH = 8
+WRITE_PIPELINE_DEPTH = 8
+PREALLOCATE_MIN_SIZE = 1024 * 1024
+POOL_WORKERS = 8
+PIPE_SIZE = 1024 * 1024
+# Not exposed by the `fcntl` module before Python 3.10
+F_SETPIPE_SZ = getattr(fcntl, 'F_SETPIPE_SZ', 1031)
+
+
+def _common_prefix_len(parts1: List[str], parts2: List[str]) -> int:
+    length = min(len(parts1), len(parts2))
+    for i in range(length):
+        if parts1[i] != parts2[i]:
+            return i
+    return length
 
 
 def _validate_path(remote_path: str):
@@ -36,18 +65,239 @@ def _validate_path(remote_path: str):
         raise NiceTrySagi(f'Cannot access hidden directories: {remote_path}')
 
 
+def _enlarge_pipe(pipe):
+    """Best effort, the kernel caps unprivileged pipes at /proc/sys/fs/pipe-max-size"""
+    try:
+        fcntl.fcntl(pipe.fileno(), F_SETPIPE_SZ, PIPE_SIZE)
+    except OSError:
+        pass
+
+
+def _prefetch(chunks: Iterable[bytes], depth: int = PREFETCH_DEPTH) -> Iterable[bytes]:
+    """Consume `chunks` on a background thread, staying up to `depth` chunks ahead of the caller"""
+    chunk_queue = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    end = object()
+
+    def put(item) -> bool:
+        """Gives up once the consumer stopped, it may never take anything from the queue again"""
+        while not stop.is_set():
+            try:
+                chunk_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def producer():
+        try:
+            for chunk in chunks:
+                if not put(chunk):
+                    return
+            put(end)
+        except BaseException as e:
+            put(e)
+        finally:
+            # If the consumer stopped early, let the source clean up (e.g. collect outstanding NFS replies)
+            # on this thread, which is the one that has been running it
+            close = getattr(chunks, 'close', None)
+            if close:
+                try:
+                    close()
+                except Exception:
+                    pass  # Nobody to report it to, a broken connection is noticed (and reconnected) on its next use
+
+    producer_thread = threading.Thread(target=producer, name='ampm-prefetch', daemon=True)
+    producer_thread.start()
+    try:
+        while True:
+            item = chunk_queue.get()
+            if item is end:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        producer_thread.join()
+
+
+def _pwrite_all(fd: int, data: bytes, offset: int):
+    view = memoryview(data)
+    while view:
+        wrote = os.pwrite(fd, view, offset)
+        view = view[wrote:]
+        offset += wrote
+
+
+def _open_beneath(root: str, parts: List[str]) -> int:
+    """Opens `parts` under `root` for reading, following no symlinks on the way (so it can't end up outside of it)"""
+    dir_fd = os.open(root, os.O_RDONLY | os.O_DIRECTORY | os.O_CLOEXEC)
+    try:
+        for part in parts[:-1]:
+            parent_fd = dir_fd
+            dir_fd = os.open(part, os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW | os.O_CLOEXEC, dir_fd=parent_fd)
+            os.close(parent_fd)
+        return os.open(parts[-1], os.O_RDONLY | os.O_NOFOLLOW | os.O_CLOEXEC, dir_fd=dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+def _matches_nfs_attrs(st: os.stat_result, attrs: dict) -> bool:
+    """Whether a local file is the one the NFS attributes describe, as seen through e.g. a kernel NFS mount"""
+    mtime = attrs.get("mtime")
+    if not stat.S_ISREG(st.st_mode) or st.st_size != attrs.get("size") or mtime is None:
+        return False
+    if st.st_mtime_ns // 10 ** 9 != mtime["seconds"]:
+        return False
+    # Servers that keep whole-second mtimes report no nanoseconds
+    if mtime["nseconds"] and st.st_mtime_ns % 10 ** 9 != mtime["nseconds"]:
+        return False
+    # The kernel's NFS client uses the fileid as the inode number
+    if "fileid" in attrs and st.st_ino != attrs["fileid"]:
+        return False
+    return True
+
+
+def _preallocate(fd: int, size: int):
+    """Reserve the file's extents up front, so the filesystem doesn't have to grow it write by write"""
+    try:
+        os.posix_fallocate(fd, 0, size)
+    except OSError as e:
+        if e.errno not in (errno.EOPNOTSUPP, errno.EINVAL):
+            raise
+
+
+def _gunzip(chunks: Iterable[bytes], max_chunk_size: int = 4 * 1024 * 1024) -> Iterable[bytes]:
+    """In-process equivalent of `gzip -d`, including streams of multiple concatenated gzip members"""
+    decompressor = zlib.decompressobj(wbits=31)
+    in_member = False
+    for chunk in chunks:
+        while chunk:
+            in_member = True
+            # Bounded, so a small but highly compressible chunk doesn't inflate all at once
+            data = decompressor.decompress(chunk, max_chunk_size)
+            if data:
+                yield data
+            if decompressor.eof:
+                chunk = decompressor.unused_data
+                decompressor = zlib.decompressobj(wbits=31)
+                in_member = False
+            else:
+                chunk = decompressor.unconsumed_tail
+
+    if in_member:
+        # Input ended mid-member, drain what we can and report it
+        data = decompressor.flush()
+        if data:
+            yield data
+        raise IOError("Compressed stream ended unexpectedly")
+
+
+# Host -> (mount port, NFS port), so only the first connection to a server asks portmap
+_service_ports: Dict[str, Tuple[int, int]] = {}
+_service_ports_lock = threading.Lock()
+
+
+def _get_service_ports(host: str, refresh: bool = False) -> Tuple[int, int]:
+    with _service_ports_lock:
+        if not refresh and host in _service_ports:
+            return _service_ports[host]
+
+    portmap = Portmap(host, timeout=3600)
+    portmap.connect()
+    try:
+        ports = (portmap.getport(Mount.program, Mount.program_version), portmap.getport(NFS_PROGRAM, NFS_V3))
+    finally:
+        portmap.disconnect()
+
+    with _service_ports_lock:
+        _service_ports[host] = ports
+    return ports
+
+
+def _forget_service_ports(host: str):
+    with _service_ports_lock:
+        _service_ports.pop(host, None)
+
+
+class _PathLru:
+    """
+    LRU mapping of path parts to values, most recently used last.
+    Also indexes the paths by their parents, so a path can be dropped along with everything under it
+    without going over the whole cache.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._entries: "OrderedDict[Tuple[str, ...], Any]" = OrderedDict()
+        # Path -> the paths directly under it that are cached, or have cached paths under them
+        self._children: Dict[Tuple[str, ...], Set[Tuple[str, ...]]] = {}
+
+    def get(self, path: Tuple[str, ...]):
+        value = self._entries.get(path)
+        if value is not None:
+            self._entries.move_to_end(path)
+        return value
+
+    def put(self, path: Tuple[str, ...], value):
+        if path not in self._entries:
+            self._link(path)
+        self._entries[path] = value
+        self._entries.move_to_end(path)
+        while len(self._entries) > self.max_size:
+            evicted, _ = self._entries.popitem(last=False)
+            self._unlink(evicted)
+
+    def pop(self, path: Tuple[str, ...]):
+        if self._entries.pop(path, None) is not None:
+            self._unlink(path)
+
+    def pop_subtree(self, path: Tuple[str, ...]):
+        """Drop `path` and everything under it"""
+        subtree = []
+        pending = [path]
+        while pending:
+            current = pending.pop()
+            subtree.append(current)
+            pending.extend(self._children.get(current, ()))
+        for cached_path in subtree:
+            self.pop(cached_path)
+
+    def clear(self):
+        self._entries.clear()
+        self._children.clear()
+
+    def _link(self, path: Tuple[str, ...]):
+        while path:
+            siblings = self._children.setdefault(path[:-1], set())
+            if path in siblings:
+                return  # So are all of its parents
+            siblings.add(path)
+            path = path[:-1]
+
+    def _unlink(self, path: Tuple[str, ...]):
+        # Parents stay indexed while they're cached themselves, or still have something under them
+        while path and path not in self._entries and not self._children.get(path):
+            siblings = self._children[path[:-1]]
+            siblings.discard(path)
+            if not siblings:
+                del self._children[path[:-1]]
+            path = path[:-1]
+
+
 def _retry_reconnect_and_reduce_chunk_size(fn):
+    @functools.wraps(fn)
     def inner(self, *args, chunk_size, **kwargs):
         chunk_size = min(self.chunk_size_limit, chunk_size)
-        is_first = True
-        while self.chunk_size_limit > 1024 or is_first:
+        while True:
             try:
                 return fn(self, *args, chunk_size=chunk_size, **kwargs)
             except Exception as e:
+                # Only the error path pays for the bookkeeping below
                 if chunk_size <= 1024:
                     raise
                 self.chunk_size_limit = chunk_size = int(ceil(chunk_size / 2 / 1024) * 1024)
-                is_first = False
                 print(f'WARN: Lowering chunk size to {chunk_size} due to IO related error: {e}', file=sys.stderr)
                 self._reconnect()
 
@@ -59,11 +309,21 @@ class NfsConnection:
         self.host = host
         self.remote_path = remote_path
         self.mount: Mount = None
-        self.portmap: Portmap = None
         self.nfs3: NFSv3 = None
         self.root_fh: bytes = None
         self.chunk_size_limit = 1024 * 1024 * 1024  # 1 GiB
+        # The server's preferred READ/WRITE sizes (from FSINFO), larger requests would be cut short anyway
+        self.read_size_pref = 1024 * 1024 * 1024
+        self.write_size_pref = 1024 * 1024 * 1024
         self.supports_readdirplus = True
+        # Where the export is also accessible locally (e.g. a kernel NFS mount), files are copied from there if set
+        self.local_mount = os.environ.get('AMPM_NFS_LOCAL_MOUNT') or None
+
+        # Path parts -> (file handle, attributes, expiry)
+        self._fh_cache = _PathLru(FH_CACHE_SIZE)
+        # Path parts -> expiry, for paths that didn't exist
+        self._neg_cache = _PathLru(FH_CACHE_SIZE)
+        self._fh_cache_lock = threading.Lock()
 
         self.auth = {
             "flavor": 1,
@@ -80,25 +340,32 @@ class NfsConnection:
 
     def _connect(self):
         _validate_path(self.remote_path)
-
-        # portmap initialization
-        self.portmap = Portmap(self.host, timeout=3600)
-        self.portmap.connect()
+        self._fh_cache_clear()
 
         # mount initialization
-        mnt_port = self.portmap.getport(Mount.program, Mount.program_version)
+        mnt_port, nfs_port = _get_service_ports(self.host)
         self.mount = Mount(host=self.host, port=mnt_port, timeout=3600, auth=self.auth)
-        self.mount.connect()
+        try:
+            self.mount.connect()
+        except Exception:
+            # The server may have restarted on different ports since we asked
+            mnt_port, nfs_port = _get_service_ports(self.host, refresh=True)
+            self.mount = Mount(host=self.host, port=mnt_port, timeout=3600, auth=self.auth)
+            self.mount.connect()
 
         # do mount
         mnt_res = self.mount.mnt(self.remote_path, self.auth)
         if mnt_res["status"] == MNT3_OK:
             self.nfs3 = None
             try:
-                nfs_port = self.portmap.getport(NFS_PROGRAM, NFS_V3)
                 self.nfs3 = NFSv3(self.host, nfs_port, NFS_OP_TIMEOUT_SEC, self.auth)
                 self.nfs3.connect()
                 self.root_fh = mnt_res["mountinfo"]["fhandle"]
+
+                fsinfo_res = self.nfs3.fsinfo(self.root_fh)
+                if fsinfo_res["status"] == NFS3_OK:
+                    self.read_size_pref = fsinfo_res["resok"]["rtpref"] or self.read_size_pref
+                    self.write_size_pref = fsinfo_res["resok"]["wtpref"] or self.write_size_pref
             except Exception:
                 if self.nfs3:
                     self.nfs3.disconnect()
@@ -106,27 +373,23 @@ class NfsConnection:
                 self.mount.umnt(self.auth)
                 self.mount.disconnect()
                 self.mount = None
-                self.portmap.disconnect()
-                self.portmap = None
+                # Ask portmap again next time, in case the NFS port is stale
+                _forget_service_ports(self.host)
                 raise
         else:
             self.mount.disconnect()
             self.mount = None
-            self.portmap.disconnect()
-            self.portmap = None
             raise ConnectionError(f"NFS mount failed: code={mnt_res['status']} ({NFSSTAT3[mnt_res['status']]})")
 
-    def _disconnect(self):
+    def _disconnect(self, unmount=True):
         if self.nfs3:
             self.nfs3.disconnect()
             self.nfs3 = None
         if self.mount:
-            self.mount.umnt(self.auth)
+            if unmount:
+                self.mount.umnt(self.auth)
             self.mount.disconnect()
             self.mount = None
-        if self.portmap:
-            self.portmap.disconnect()
-            self.portmap = None
 
     @contextlib.contextmanager
     def connected(self) -> ContextManager["NfsConnection"]:
@@ -136,29 +399,97 @@ class NfsConnection:
 
     @staticmethod
     def _splitpath(remote_path: str) -> List[str]:
-        remote_path = list(remote_path.strip('/').split('/'))
-        while '' in remote_path:
-            remote_path.remove('')
-        while '.' in remote_path:
-            remote_path.remove('.')
-        return remote_path
+        return [part for part in remote_path.strip('/').split('/') if part and part != '.']
+
+    def _fh_cache_get(self, path: Tuple[str, ...]) -> Optional[Tuple[bytes, dict]]:
+        with self._fh_cache_lock:
+            entry = self._fh_cache.get(path)
+            if entry is None:
+                return None
+            if entry[2] < time.monotonic():
+                self._fh_cache.pop(path)
+                return None
+            return entry[0], entry[1]
+
+    def _fh_cache_put(self, path: Tuple[str, ...], fh: bytes, attrs: dict):
+        ttl = FH_CACHE_TTL_SEC if attrs.get("type") == NF3DIR else FILE_ATTR_CACHE_TTL_SEC
+        with self._fh_cache_lock:
+            self._neg_cache.pop(path)
+            self._fh_cache.put(path, (fh, attrs, time.monotonic() + ttl))
+
+    def _neg_cache_put(self, path: Tuple[str, ...], dir_attrs: dict):
+        # Only trusted while the parent directory is unchanged, so without its mtime there's nothing to check against
+        if "mtime" not in dir_attrs or time.time() - dir_attrs["mtime"]["seconds"] < NEGATIVE_LOOKUP_MIN_DIR_AGE_SEC:
+            return
+        with self._fh_cache_lock:
+            self._neg_cache.put(path, (time.monotonic() + NEGATIVE_LOOKUP_CACHE_TTL_SEC, dir_attrs["mtime"]))
+
+    def _neg_cache_contains(self, path: Tuple[str, ...], dir_fh: bytes) -> bool:
+        """
+        Like the kernel's negative dentries, a missing path is only trusted while the mtime of its parent
+        (`dir_fh`) is unchanged, any entry added to it since (e.g. by another client) changes that.
+        """
+        with self._fh_cache_lock:
+            entry = self._neg_cache.get(path)
+            if entry is None:
+                return False
+            expiry, dir_mtime = entry
+            if expiry < time.monotonic():
+                self._neg_cache.pop(path)
+                return False
+
+        getattr_res = self.nfs3.getattr(dir_fh)
+        if getattr_res["status"] == NFS3_OK and getattr_res["attributes"]["mtime"] == dir_mtime:
+            return True
+        with self._fh_cache_lock:
+            self._neg_cache.pop(path)
+        return False
+
+    def _fh_cache_invalidate(self, path: Tuple[str, ...]):
+        """Drop `path` and everything under it from the caches"""
+        with self._fh_cache_lock:
+            self._fh_cache.pop_subtree(path)
+            self._neg_cache.pop_subtree(path)
+
+    def _fh_cache_clear(self):
+        with self._fh_cache_lock:
+            self._fh_cache.clear()
+            self._neg_cache.clear()
+
+    def _longest_cached_prefix(self, remote_path: Tuple[str, ...]) -> (int, bytes, dict):
+        for depth in range(len(remote_path), 0, -1):
+            cached = self._fh_cache_get(remote_path[:depth])
+            if cached:
+                return depth, cached[0], cached[1]
+        return 0, self.root_fh, {}
 
     # Returns (file handle, file attributes)
     def _open(self, remote_path: List[str]) -> (bytes, dict):
-        fh = self.root_fh
-        attrs = {}
-        for path_part in remote_path:
-            lookup_res = self.nfs3.lookup(fh, path_part)
+        remote_path = tuple(remote_path)
+        depth, fh, attrs = self._longest_cached_prefix(remote_path)
+        for i in range(depth, len(remote_path)):
+            if self._neg_cache_contains(remote_path[:i + 1], fh):
+                raise IOError(f"NFS lookup failed: code={NFS3ERR_NOENT} ({NFSSTAT3[NFS3ERR_NOENT]}, cached)")
+
+            lookup_res = self.nfs3.lookup(fh, remote_path[i])
             if lookup_res["status"] == NFS3_OK:
                 fh = lookup_res["resok"]["object"]["data"]
-                attrs = lookup_res["resok"]["obj_attributes"]["attributes"]
+                attrs = lookup_res["resok"]["obj_attributes"].get("attributes", {})
+                self._fh_cache_put(remote_path[:i + 1], fh, attrs)
+            elif depth > 0 and lookup_res["status"] in (NFS3ERR_STALE, NFS3ERR_BADHANDLE):
+                # The cached handle is stale (e.g. removed by another client), retry from the root
+                self._fh_cache_invalidate(remote_path[:depth])
+                return self._open(list(remote_path))
             else:
+                if lookup_res["status"] == NFS3ERR_NOENT:
+                    self._neg_cache_put(remote_path[:i + 1], lookup_res["resfail"].get("attributes", {}))
                 raise IOError(f"NFS lookup failed: code={lookup_res['status']} ({NFSSTAT3[lookup_res['status']]})")
 
         return fh, attrs
 
     def _remove(self, remote_path: List[str]):
         fh = self._open(remote_path[:-1])[0]
+        self._fh_cache_invalidate(tuple(remote_path))
         remove_res = self.nfs3.remove(fh, remote_path[-1])
         if remove_res["status"] != NFS3_OK:
             raise IOError(f"NFS remove failed: code={remove_res['status']} ({NFSSTAT3[remove_res['status']]})")
@@ -172,56 +503,103 @@ class NfsConnection:
             print('Removing:', path, file=sys.stderr)
             self.remove(path)
 
+    def _lookup_until_missing(self, remote_path: Tuple[str, ...]) -> (int, bytes):
+        """
+        Looks up the directories in `remote_path` until one is missing.
+        Returns how many of them exist, and the file handle of the deepest one.
+        """
+        depth, dir_fh, attrs = self._longest_cached_prefix(remote_path)
+        for i in range(depth, len(remote_path)):
+            if self._neg_cache_contains(remote_path[:i + 1], dir_fh):
+                return i, dir_fh
+
+            lookup_res = self.nfs3.lookup(dir_fh, remote_path[i])
+            if lookup_res["status"] == NFS3_OK:
+                attrs = lookup_res["resok"]["obj_attributes"].get("attributes", {})
+                if attrs.get("type", NF3DIR) != NF3DIR:
+                    raise IOError("Tried to create directory but file exists with same name")
+                dir_fh = lookup_res["resok"]["object"]["data"]
+                self._fh_cache_put(remote_path[:i + 1], dir_fh, attrs)
+            elif lookup_res["status"] == NFS3ERR_NOENT:
+                return i, dir_fh
+            elif depth > 0 and lookup_res["status"] in (NFS3ERR_STALE, NFS3ERR_BADHANDLE):
+                # The cached handle is stale (e.g. removed by another client), retry from the root
+                self._fh_cache_invalidate(remote_path[:depth])
+                return self._lookup_until_missing(remote_path)
+            else:
+                raise IOError(f"NFS lookup failed: code={lookup_res['status']} ({NFSSTAT3[lookup_res['status']]})")
+
+        return len(remote_path), dir_fh
+
     def _mkdir_recursive(self, remote_path: List[str]):
-        dir_fh = self.root_fh
-        for path_part in remote_path:
+        remote_path = tuple(remote_path)
+        # Usually most of the path exists already, so only the missing part costs a MKDIR
+        depth, dir_fh = self._lookup_until_missing(remote_path)
+        for i in range(depth, len(remote_path)):
+            path_part = remote_path[i]
             mkdir_res = self.nfs3.mkdir(dir_fh, path_part, mode=0o777)
-            # print('--- mkdir_res ---')
-            # print(mkdir_res)
             if mkdir_res["status"] == NFS3_OK:
                 dir_fh = mkdir_res["resok"]["obj"]["handle"]["data"]
+                attrs = mkdir_res["resok"]["obj_attributes"].get("attributes", {})
             else:
-                # Maybe it already exists?
+                # Maybe someone else created it in the meantime?
                 if mkdir_res["status"] == NFS3ERR_EXIST:
                     # Make sure it's a directory
                     if mkdir_res["resfail"]["after"]["attributes"]["type"] != 2:
                         raise IOError("Tried to create directory but file exists with same name")
 
                 lookup_res = self.nfs3.lookup(dir_fh, path_part)
-                # print('--- lookup_res ---')
-                # print(lookup_res)
                 if lookup_res["status"] == NFS3_OK:
                     dir_fh = lookup_res["resok"]["object"]["data"]
+                    attrs = lookup_res["resok"]["obj_attributes"].get("attributes", {})
                 else:
                     raise IOError(f"NFS mkdir.lookup failed: code={lookup_res['status']} ({NFSSTAT3[lookup_res['status']]})")
 
+            self._fh_cache_put(remote_path[:i + 1], dir_fh, attrs)
+
         return dir_fh
 
     def _create_with_dirs(self, remote_path: List[str]):
         dir_fh = self._mkdir_recursive(remote_path[:-1])
+        self._fh_cache_invalidate(tuple(remote_path))
 
         create_res = self.nfs3.create(dir_fh, remote_path[-1], UNCHECKED, mode=0o777, size=0)
-        # print('--- create_res ---')
-        # print(create_res)
         if create_res["status"] == NFS3_OK:
             return create_res["resok"]["obj"]["handle"]["data"]
         else:
             raise IOError(f"NFS create failed: code={create_res['status']} ({NFSSTAT3[create_res['status']]})")
 
-    def list_dir(self, remote_path: str):
-        _validate_path(remote_path)
-        fh, _attrs = self._open(self._splitpath(remote_path))
+    def _iter_readdir(self, fh: bytes, plus: Optional[bool] = None) -> Iterable[List[Tuple[bytes, Optional[dict], Optional[bytes]]]]:
+        """
+        Yields the entries of a directory, one list of (name, attributes, file handle) per reply.
+        Attributes and handles are only present when using READDIRPLUS.
+        """
+        if plus is None:
+            plus = self.supports_readdirplus
         cookie = 0
         cookie_verf = '0'
         while True:
-            readdir_res = self.nfs3.readdir(fh, cookie=cookie, cookie_verf=cookie_verf)
+            readdir_res = None
+            if plus:
+                readdir_res = self.nfs3.readdirplus(fh, cookie=cookie, cookie_verf=cookie_verf)
+                if readdir_res["status"] == NFS3ERR_NOTSUPP:
+                    self.supports_readdirplus = plus = False
+
+            if not plus:
+                readdir_res = self.nfs3.readdir(fh, cookie=cookie, cookie_verf=cookie_verf)
+
             if readdir_res["status"] == NFS3_OK:
                 cookie_verf = readdir_res["resok"]["cookieverf"]
+                page = []
                 entry = readdir_res["resok"]["reply"]["entries"]
                 while entry:
-                    yield entry[0]['name']
-                    cookie = entry[0]['cookie']
-                    entry = entry[0]['nextentry']
+                    entry = entry[0]
+                    attrs = entry.get("name_attributes", {}).get("attributes")
+                    handle = entry.get("name_handle", {}).get("handle")
+                    page.append((entry["name"], attrs, handle["data"] if handle else None))
+                    cookie = entry["cookie"]
+                    entry = entry["nextentry"]
+                yield page
                 if readdir_res["resok"]["reply"]["eof"]:
                     break
             elif readdir_res["status"] == NFS3ERR_NOTDIR:
@@ -229,66 +607,75 @@ class NfsConnection:
             else:
                 raise IOError(f"NFS readdir failed: code={readdir_res['status']} ({NFSSTAT3[readdir_res['status']]})")
 
+    def list_dir(self, remote_path: str, with_attrs: bool = False):
+        """
+        Yields the names in a directory (including '.' and '..').
+        With `with_attrs`, yields (name, attributes) instead, where attributes may be None if the server
+        doesn't support READDIRPLUS. Handles returned along with them are cached for later lookups.
+        """
+        _validate_path(remote_path)
+        dir_parts = tuple(self._splitpath(remote_path))
+        fh, _attrs = self._open(list(dir_parts))
+        for page in self._iter_readdir(fh, plus=None if with_attrs else False):
+            for name, attrs, child_fh in page:
+                if not with_attrs:
+                    yield name
+                    continue
+                if attrs is not None and child_fh is not None and name not in (b'.', b'..'):
+                    self._fh_cache_put(dir_parts + (name.decode(),), child_fh, attrs)
+                yield name, attrs
+
     def walk_files(self, remote_path: str, include_dirs: bool = False):
         _validate_path(remote_path)
         fh, _attrs = self._open(self._splitpath(remote_path))
-        cookie = 0
-        cookie_verf = '0'
-        while True:
-            readdir_res = None
-            if self.supports_readdirplus:
-                readdir_res = self.nfs3.readdirplus(fh, cookie=cookie, cookie_verf=cookie_verf)
-                if readdir_res["status"] == NFS3ERR_NOTSUPP:
-                    self.supports_readdirplus = False
 
-            if not self.supports_readdirplus:
-                readdir_res = self.nfs3.readdir(fh, cookie=cookie, cookie_verf=cookie_verf)
+        # Depth-first, so every directory's contents are contiguous (`walk_files_dirs_at_end` relies on it)
+        to_visit = [(remote_path, fh)]
+        while to_visit:
+            dir_path, fh = to_visit.pop()
+            if fh is None:
+                fh, _attrs = self._open(self._splitpath(dir_path))
 
-            if readdir_res["status"] == NFS3_OK:
-                if include_dirs:
-                    yield remote_path
-                cookie_verf = readdir_res["resok"]["cookieverf"]
-                entry = readdir_res["resok"]["reply"]["entries"]
-                while entry:
-                    if not entry[0]['name'].startswith(b'.'):
-                        next_path = remote_path + '/' + entry[0]['name'].decode()
-                        if ('name_attributes' in entry[0] and
-                                entry[0]['name_attributes']['attributes']['type'] != NF3DIR):
-                            yield next_path
+            subdirs = []
+            try:
+                for page_index, page in enumerate(self._iter_readdir(fh)):
+                    if include_dirs and page_index == 0:
+                        yield dir_path
+                    for name, attrs, child_fh in page:
+                        if name.startswith(b'.'):
+                            continue
+                        child_path = dir_path + '/' + name.decode()
+                        if attrs is not None and child_fh is not None:
+                            self._fh_cache_put(tuple(self._splitpath(child_path)), child_fh, attrs)
+                        if attrs is not None and attrs["type"] != NF3DIR:
+                            yield child_path
                         else:
-                            yield from self.walk_files(next_path, include_dirs)
-                    cookie = entry[0]['cookie']
-                    entry = entry[0]['nextentry']
-                if readdir_res["resok"]["reply"]["eof"]:
-                    break
-            elif readdir_res["status"] == NFS3ERR_NOTDIR:
-                yield remote_path
-                return
-            else:
-                raise IOError(f"NFS readdirplus failed: code={readdir_res['status']} ({NFSSTAT3[readdir_res['status']]})")
+                            subdirs.append((child_path, child_fh))
+            except NotADirectoryError:
+                yield dir_path
+                continue
+
+            to_visit.extend(reversed(subdirs))
 
     def walk_files_dirs_at_end(self, remote_path: str):
         """Transform the output of `walk_files` such that the dirs appear after their contents"""
-        last = ''
+        # Components of the last path seen, every prefix of it that we leave is finished
+        last_parts = []
 
         for path in self.walk_files(remote_path, include_dirs=True):
-            if not path.startswith(last + '/') and last:
-                current_parts = path.split('/')
-                last_parts = last.split('/')
-                common_parts = list(_common_prefix(current_parts, last_parts))
-                for subdir in [last_parts[:i] for i in range(len(last_parts), len(common_parts), -1)]:
-                    yield '/'.join(subdir)
-            last = path
-
-        if not last:
+            current_parts = path.split('/')
+            common = _common_prefix_len(current_parts, last_parts)
+            for i in range(len(last_parts), common, -1):
+                yield '/'.join(last_parts[:i])
+            last_parts = current_parts
+
+        if not last_parts:
             # Empty directory
             return
 
-        base_parts = remote_path.split('/')[:-1]
-        last_parts = last.split('/')
-        common_parts = list(_common_prefix(base_parts, last_parts))
-        for subdir in [last_parts[:i] for i in range(len(last_parts), len(common_parts), -1)]:
-            yield '/'.join(subdir)
+        common = _common_prefix_len(remote_path.split('/')[:-1], last_parts)
+        for i in range(len(last_parts), common, -1):
+            yield '/'.join(last_parts[:i])
 
     def rename(self, old_path: str, new_path: str):
         _validate_path(old_path)
@@ -297,6 +684,8 @@ class NfsConnection:
         new_path_parts = self._splitpath(new_path)
         old_fh, _attrs = self._open(old_path_parts[:-1])
         new_fh = self._mkdir_recursive(new_path_parts[:-1])
+        self._fh_cache_invalidate(tuple(old_path_parts))
+        self._fh_cache_invalidate(tuple(new_path_parts))
         rename_res = self.nfs3.rename(old_fh, old_path_parts[-1], new_fh, new_path_parts[-1])
 
         return rename_res["status"] == NFS3_OK
@@ -305,10 +694,22 @@ class NfsConnection:
         _validate_path(link_path)
         link_path = self._splitpath(link_path)
         fh, _attrs = self._open(link_path[:-1])
+        self._fh_cache_invalidate(tuple(link_path))
         symlink_res = self.nfs3.symlink(fh, link_path[-1], dest_path)
         if symlink_res["status"] != NFS3_OK:
             raise IOError(f"NFS symlink failed: code={symlink_res['status']} ({NFSSTAT3[symlink_res['status']]})")
 
+    def link(self, existing_path: str, link_path: str):
+        _validate_path(existing_path)
+        _validate_path(link_path)
+        existing_fh, _attrs = self._open(self._splitpath(existing_path))
+        link_path = self._splitpath(link_path)
+        dir_fh, _attrs = self._open(link_path[:-1])
+        self._fh_cache_invalidate(tuple(link_path))
+        link_res = self.nfs3.link(existing_fh, dir_fh, link_path[-1])
+        if link_res["status"] != NFS3_OK:
+            raise IOError(f"NFS link failed: code={link_res['status']} ({NFSSTAT3[link_res['status']]})")
+
     def readlink(self, remote_path: str) -> bytes:
         _validate_path(remote_path)
         link_path = self._splitpath(remote_path)
@@ -321,7 +722,10 @@ class NfsConnection:
 
     @_retry_reconnect_and_reduce_chunk_size
     def _read(self, fh, offset, chunk_size):
-        read_res = self.nfs3.read(fh, offset, chunk_size)
+        return self._read_res_data(self.nfs3.read(fh, offset, chunk_size))
+
+    @staticmethod
+    def _read_res_data(read_res) -> bytes:
         if read_res["status"] == NFS3_OK:
             data = read_res["resok"]["data"]
             if len(data) == 0:
@@ -332,108 +736,404 @@ class NfsConnection:
         else:
             raise IOError(f"NFS read failed: code={read_res['status']} ({NFSSTAT3[read_res['status']]})")
 
+    @staticmethod
+    def _as_bytes(view: memoryview) -> bytes:
+        if isinstance(view.obj, bytes) and len(view) == len(view.obj):
+            # It's the whole underlying bytes object (the common case), which can be sent as-is
+            return view.obj
+        return bytes(view)
+
+    @staticmethod
+    def _write_res_count(write_res) -> int:
+        if write_res["status"] == NFS3_OK:
+            if write_res["resok"]["count"] == 0:
+                raise IOError("NFS write returned 0 bytes")
+            return write_res["resok"]["count"]
+        else:
+            raise IOError(f"NFS write failed: code={write_res['status']} ({NFSSTAT3[write_res['status']]})")
+
     @_retry_reconnect_and_reduce_chunk_size
     def _write(self, fh, offset, content, chunk_size):
+        # `content` is a memoryview, only the part that's actually sent is copied
+        content = self._as_bytes(content[:chunk_size])
         write_res = self.nfs3.write(
             fh,
             offset=offset,
-            count=min(len(content), chunk_size),
-            content=content[:chunk_size],
+            count=len(content),
+            content=content,
             stable_how=UNSTABLE,
         )
-        # print('--- write_res ---')
-        # print(write_res)
-        if write_res["status"] == NFS3_OK:
-            if write_res["resok"]["count"] == 0:
-                raise IOError("NFS write returned 0 bytes")
-            return write_res["resok"]["count"]
+        return self._write_res_count(write_res)
+
+    def _write_pipelined(self, fh: bytes, offset: int, contents: Iterable[bytes], chunk_size: int) -> int:
+        """
+        Writes `contents` one after the other starting at `offset`, returns the offset after the last one.
+        Up to WRITE_PIPELINE_DEPTH UNSTABLE WRITEs are in flight at once, the caller is expected to COMMIT afterwards.
+        """
+        chunk_size = min(chunk_size, self.chunk_size_limit, self.write_size_pref)
+        # (xid, offset, piece), in offset order
+        in_flight = deque()
+
+        def collect_oldest():
+            xid, piece_offset, piece = in_flight[0]
+            wrote = self._write_res_count(self.nfs3.recv_write(xid))
+            if wrote < len(piece):
+                # Short write, send the rest synchronously
+                self._write_all(fh, piece_offset + wrote, piece[wrote:], chunk_size)
+            in_flight.popleft()
+
+        def recover(e: Exception):
+            # The connection's state is unknown, start over and resend everything that wasn't acknowledged
+            # (`_write_all` lowers the chunk size if it keeps failing)
+            nonlocal chunk_size
+            print(f'WARN: Pipelined write failed, retrying: {e}', file=sys.stderr)
+            self._reconnect()
+            for _xid, piece_offset, piece in in_flight:
+                self._write_all(fh, piece_offset, piece, chunk_size)
+            in_flight.clear()
+            chunk_size = min(chunk_size, self.chunk_size_limit)
+
+        for content in contents:
+            view = memoryview(content)
+            while view:
+                piece = self._as_bytes(view[:chunk_size])
+                view = view[len(piece):]
+                try:
+                    if len(in_flight) >= WRITE_PIPELINE_DEPTH:
+                        collect_oldest()
+                    xid = self.nfs3.send_write(fh, offset, len(piece), piece, UNSTABLE)
+                except Exception as e:
+                    recover(e)
+                    self._write_all(fh, offset, piece, chunk_size)
+                else:
+                    in_flight.append((xid, offset, piece))
+                offset += len(piece)
+
+        while in_flight:
+            try:
+                collect_oldest()
+            except Exception as e:
+                recover(e)
+
+        return offset
+
+    def _open_fresh(self, remote_path: List[str]) -> (bytes, dict):
+        """
+        Like `_open`, but the attributes are always current, even if the handle is cached (close-to-open consistency).
+        Reading with a cached size would silently cut off a file that another client has since rewritten.
+        """
+        cached = self._fh_cache_get(tuple(remote_path))
+        if cached is None:
+            # The LOOKUP returns current attributes
+            return self._open(remote_path)
+
+        fh = cached[0]
+        getattr_res = self.nfs3.getattr(fh)
+        if getattr_res["status"] == NFS3_OK:
+            attrs = getattr_res["attributes"]
+            self._fh_cache_put(tuple(remote_path), fh, attrs)
+            return fh, attrs
+        elif getattr_res["status"] in (NFS3ERR_STALE, NFS3ERR_BADHANDLE):
+            # Replaced (or removed) by another client, look it up again
+            self._fh_cache_invalidate(tuple(remote_path))
+            return self._open(remote_path)
         else:
-            raise IOError(f"NFS write failed: code={write_res['status']} ({NFSSTAT3[write_res['status']]})")
+            raise IOError(f"NFS getattr failed: code={getattr_res['status']} ({NFSSTAT3[getattr_res['status']]})")
 
-    def read_stream(self, remote_path: str, chunk_size: int = DEFAULT_CHUNK_SIZE, progress_bar=False):
+    def _open_file(self, remote_path: str) -> (bytes, dict):
         _validate_path(remote_path)
-        remote_path = self._splitpath(remote_path)
-        fh, attrs = self._open(remote_path)
+        fh, attrs = self._open_fresh(self._splitpath(remote_path))
         if attrs["type"] != 1:
             raise IOError("Tried to read a non-file")
+        return fh, attrs
 
+    def _read_pipelined(self, fh: bytes, offset: int, end: int, chunk_size: int) -> Iterable[bytes]:
+        """
+        Yields the contents of the file from `offset` to `end`.
+        Up to READ_PIPELINE_DEPTH READs are in flight at once, so the transfer isn't bound by the round trip time.
+        """
+        # (xid, offset, count), in offset order
+        in_flight = deque()
+        next_offset = offset
+        try:
+            while next_offset < end or in_flight:
+                while next_offset < end and len(in_flight) < READ_PIPELINE_DEPTH:
+                    count = min(chunk_size, end - next_offset)
+                    in_flight.append((self.nfs3.send_read(fh, next_offset, count), next_offset, count))
+                    next_offset += count
+
+                xid, chunk_offset, count = in_flight.popleft()
+                data = self._read_res_data(self.nfs3.recv_read(xid))
+                yield data
+
+                if len(data) < count:
+                    # The server's max read size is smaller than `chunk_size`, fill the gap and ask for less from now on
+                    chunk_size = len(data)
+                    gap_offset = chunk_offset + len(data)
+                    while gap_offset < chunk_offset + count:
+                        data = self._read_res_data(self.nfs3.read(fh, gap_offset, chunk_offset + count - gap_offset))
+                        gap_offset += len(data)
+                        yield data
+        except GeneratorExit:
+            # Stopped early, collect the replies that are still on their way so they don't pile up
+            for xid, _offset, _count in in_flight:
+                self.nfs3.recv_reply(xid)
+            raise
+
+    def _read_chunks(self, remote_path: List[str], fh: bytes, attrs: dict, chunk_size: int, progress_bar=False):
+        size = attrs["size"]
         offset = 0
-        left = attrs["size"]
         bar = None
         if progress_bar:
-            bar = tqdm.tqdm(total=ceil(attrs["size"] / 1024), desc=f"Reading {remote_path[-1]}", unit='KiB')
+            bar = tqdm.tqdm(
+                total=size, desc=f"Reading {remote_path[-1]}", unit='B', unit_scale=True, unit_divisor=1024
+            )
 
-        while left > 0:
-            data = self._read(fh, offset, chunk_size=chunk_size)
-            offset += len(data)
-            left -= len(data)
-            if bar:
-                bar.update(len(data) // 1024)
-            yield data
+        chunks = None
+        try:
+            while offset < size:
+                if chunks is None:
+                    chunks = self._read_pipelined(
+                        fh, offset, size, min(chunk_size, self.chunk_size_limit, self.read_size_pref)
+                    )
+                try:
+                    data = next(chunks)
+                except Exception as e:
+                    # The connection's state is unknown, start over and fall back to a single READ
+                    # (which lowers the chunk size if it keeps failing). The handle may be stale, so look it up again.
+                    print(f'WARN: Pipelined read failed, retrying: {e}', file=sys.stderr)
+                    chunks = None
+                    self._reconnect()
+                    self._fh_cache_invalidate(tuple(remote_path))
+                    fh, new_attrs = self._open(remote_path)
+                    if new_attrs.get("fileid") != attrs.get("fileid") or new_attrs.get("size") != size:
+                        # Continuing would mix the contents of two different files
+                        raise IOError(f"{'/'.join(remote_path)} was replaced while being read") from e
+                    data = self._read(fh, offset, chunk_size=min(chunk_size, self.read_size_pref))
+
+                offset += len(data)
+                if bar:
+                    bar.update(len(data))
+                yield data
+        finally:
+            if chunks is not None:
+                chunks.close()
 
         if bar:
             bar.reset()
             bar.update(bar.total)
             bar.close()
 
-    def read(self, remote_path: str, chunk_size: int = DEFAULT_CHUNK_SIZE, progress_bar=False):
-        _validate_path(remote_path)
-        return b''.join(list(self.read_stream(remote_path, chunk_size, progress_bar)))
+    def read_stream(self, remote_path: str, chunk_size: int = DEFAULT_CHUNK_SIZE, progress_bar=False):
+        fh, attrs = self._open_file(remote_path)
+        yield from self._read_chunks(self._splitpath(remote_path), fh, attrs, chunk_size, progress_bar)
+
+    def read(self, remote_path: str, chunk_size: int = DEFAULT_CHUNK_SIZE, progress_bar=False) -> bytearray:
+        """Read a whole file into a single buffer, preallocated to the size reported by the server"""
+        fh, attrs = self._open_file(remote_path)
+        buf = bytearray(attrs["size"])
+        offset = 0
+        for data in self._read_chunks(self._splitpath(remote_path), fh, attrs, chunk_size, progress_bar):
+            # The file may have grown since we got its size, it's truncated to that size like `read_stream` does
+            data = data[:len(buf) - offset]
+            buf[offset:offset + len(data)] = data
+            offset += len(data)
+        return buf
+
+    def _download_file(
+            self,
+            local_file_path: Path,
+            remote_file_path: str,
+            attrs: dict,
+            chunk_size: int,
+            progress_bar=False,
+            hasher=None,
+    ):
+        """`attrs` are the file's NFS attributes, as looked up before (e.g. while walking its directory)"""
+        expected_size = attrs.get("size", 0)
+        # Chunks are large, so write them straight to the fd rather than through a BufferedWriter
+        fd = os.open(local_file_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_CLOEXEC, 0o755)
+        try:
+            if expected_size >= PREALLOCATE_MIN_SIZE:
+                _preallocate(fd, expected_size)
+
+            if self.local_mount and self._copy_from_local_mount(fd, remote_file_path, attrs):
+                if hasher:
+                    with open(local_file_path, 'rb') as f:
+                        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+                            hasher.update(chunk)
+                return
+
+            offset = 0
+            for chunk in self.read_stream(remote_file_path, chunk_size, progress_bar):
+                _pwrite_all(fd, chunk, offset)
+                offset += len(chunk)
+                if hasher:
+                    hasher.update(chunk)
+
+            if offset < expected_size:
+                # The file shrank since we looked it up, drop the preallocated tail
+                os.ftruncate(fd, offset)
+        finally:
+            os.close(fd)
+
+    def _copy_from_local_mount(self, fd: int, remote_file_path: str, attrs: dict) -> bool:
+        """
+        Copies the file from `local_mount` in the kernel, instead of reading it over RPC.
+        Returns False if it's not there (or isn't the same file as `attrs` describe), in which case nothing was written.
+        """
+        try:
+            src_fd = _open_beneath(self.local_mount, self._splitpath(remote_file_path))
+        except OSError:
+            return False
+
+        try:
+            if not _matches_nfs_attrs(os.fstat(src_fd), attrs):
+                return False
+            expected_size = attrs["size"]
+            offset = 0
+            while offset < expected_size:
+                sent = os.sendfile(fd, src_fd, offset, expected_size - offset)
+                if sent == 0:
+                    break
+                offset += sent
+            if offset < expected_size or not _matches_nfs_attrs(os.fstat(src_fd), attrs):
+                # Changed while we were copying it, so the copy may be torn
+                os.ftruncate(fd, 0)
+                os.lseek(fd, 0, os.SEEK_SET)
+                return False
+            return True
+        finally:
+            os.close(src_fd)
 
     def download(
             self,
             local_path: Path,
             remote_path: str,
             chunk_size: int = DEFAULT_CHUNK_SIZE,
-            progress_bar=False
+            progress_bar=False,
+            parallel=False,
     ) -> Optional[str]:
+        """
+        Downloads a file or a directory tree, returns the file's hash if it was a single regular file.
+        With `parallel`, the files of a directory are downloaded by the connection pool's workers
+        (unless the pool is disabled, see `NfsConnectionPool`).
+        """
         _validate_path(remote_path)
-        got_one_file = False
-        hasher = hashlib.sha256(b'')
-
-        for remote_file_path in self.walk_files(remote_path):
-            if got_one_file:
-                hasher = None  # Disable hashing if we're downloading multiple files
+        remote_file_paths = list(self.walk_files(remote_path))
+        # Only single files are hashed
+        hasher = hashlib.sha256() if len(remote_file_paths) == 1 else None
+        created_dirs = set()
+        # (local path, remote path, attributes) of the regular files
+        files = []
+
+        for remote_file_path in remote_file_paths:
             local_file_path = local_path / remote_file_path[len(remote_path):].strip('/')
-            local_file_path.parent.mkdir(parents=True, exist_ok=True)
-
-            try:
-                local_file_path.symlink_to(self.readlink(remote_file_path).decode())
+            if local_file_path.parent not in created_dirs:
+                local_file_path.parent.mkdir(parents=True, exist_ok=True)
+                created_dirs.add(local_file_path.parent)
+
+            # Usually cached by `walk_files`, in which case we know whether it's a symlink without asking
+            _fh, attrs = self._open(self._splitpath(remote_file_path))
+            link_target = None
+            if attrs.get("type", NF3LNK) == NF3LNK:
+                try:
+                    link_target = self.readlink(remote_file_path)
+                except IOError:
+                    pass  # Not a symlink
+
+            if link_target is not None:
+                local_file_path.symlink_to(link_target.decode())
                 hasher = None  # Don't hash symlinks
-            except IOError:
+            else:
                 # Not a symlink, read as file
+                files.append((local_file_path, remote_file_path, attrs))
 
-                def opener(path, flags):
-                    return os.open(path, flags, 0o755)
-
-                with open(local_file_path, 'wb', opener=opener) as f:
-                    for chunk in self.read_stream(remote_file_path, chunk_size, progress_bar):
-                        f.write(chunk)
-                        if hasher:
-                            hasher.update(chunk)
-            got_one_file = True
+        if not parallel or len(files) <= 1 or not _connection_pool_enabled():
+            for local_file_path, remote_file_path, attrs in files:
+                self._download_file(local_file_path, remote_file_path, attrs, chunk_size, progress_bar, hasher)
+        else:
+            self._download_files_parallel(files, chunk_size, progress_bar)
 
         if hasher:
             return hasher.hexdigest()
 
-    def write_stream(self, contents_gen: Iterable[bytes], remote_path: str, contents_len: int, progress_bar=False):
+    def _download_files_parallel(self, files: List[Tuple[Path, str, dict]], chunk_size: int, progress_bar=False):
+        # A single connection handles one request at a time, so every worker uses its own
+        bar = None
+        if progress_bar:
+            bar = tqdm.tqdm(
+                total=sum(attrs.get("size", 0) for _local, _remote, attrs in files),
+                unit='B', unit_scale=True, unit_divisor=1024, desc="Downloading files",
+            )
+
+        def download_one(local_file_path: Path, remote_file_path: str, attrs: dict):
+            with NFS_CONNECTION_POOL.get(self.host, self.remote_path).connected() as nfs:
+                nfs._download_file(local_file_path, remote_file_path, attrs, chunk_size)
+            if bar:
+                bar.update(attrs.get("size", 0))
+
+        futures = [NFS_CONNECTION_POOL.executor().submit(download_one, *f) for f in files]
+        try:
+            for future in futures:
+                future.result()
+        finally:
+            # On error, don't leave workers writing into the destination after we return
+            for future in futures:
+                future.cancel()
+            concurrent.futures.wait(futures)
+
+        if bar:
+            bar.close()
+
+    def _write_all(self, fh, offset: int, content, chunk_size: int) -> int:
+        chunk_size = min(chunk_size, self.write_size_pref)
+        view = memoryview(content)
+        while view:
+            wrote = self._write(fh, offset, content=view, chunk_size=chunk_size)
+            view = view[wrote:]
+            offset += wrote
+        return offset
+
+    def write_stream(
+            self,
+            contents_gen: Iterable[bytes],
+            remote_path: str,
+            contents_len: int,
+            progress_bar=False,
+            chunk_size: int = DEFAULT_CHUNK_SIZE,
+    ):
         _validate_path(remote_path)
         remote_path = self._splitpath(remote_path)
         fh = self._create_with_dirs(remote_path)
 
-        offset = 0
         bar = None
         if progress_bar:
-            bar = tqdm.tqdm(total=ceil(contents_len / 1024), desc=f"Writing {remote_path[-1]}", unit='KiB')
-
-        for chunk in contents_gen:
-            while chunk:
-                wrote = self._write(fh, offset, content=chunk, chunk_size=DEFAULT_CHUNK_SIZE)
-                chunk = chunk[wrote:]
-                offset += wrote
-            if bar:
-                bar.update(len(chunk) // 1024)
+            bar = tqdm.tqdm(
+                total=contents_len, desc=f"Writing {remote_path[-1]}", unit='B', unit_scale=True, unit_divisor=1024
+            )
 
+        # Coalesce small chunks so every WRITE carries a full `chunk_size` payload. Chunks are only joined
+        # when there's more than one, so e.g. a small metadata file is sent without being copied first.
+        # This holds on to yielded chunks, so they must not be reused by the generator.
+        def coalesced():
+            pending = []
+            pending_len = 0
+            for chunk in contents_gen:
+                pending.append(chunk)
+                pending_len += len(chunk)
+                if pending_len >= chunk_size:
+                    yield pending[0] if len(pending) == 1 else b''.join(pending)
+                    pending.clear()
+                    pending_len = 0
+                if bar:
+                    bar.update(len(chunk))
+
+            if pending:
+                yield pending[0] if len(pending) == 1 else b''.join(pending)
+
+        # The WRITEs are UNSTABLE, a single COMMIT at the end makes them durable
+        self._write_pipelined(fh, 0, coalesced(), chunk_size)
         self.nfs3.commit(fh)
 
         if bar:
@@ -445,24 +1145,52 @@ class NfsConnection:
         _validate_path(remote_path)
 
         def chunked():
+            # Slices of a memoryview don't copy, each piece is only turned into bytes right before it's sent
+            view = memoryview(contents)
             for i in range(0, len(contents), chunk_size):
-                yield contents[i:i + chunk_size]
+                yield view[i:i + chunk_size]
 
-        self.write_stream(chunked(), remote_path, len(contents), progress_bar)
+        self.write_stream(chunked(), remote_path, len(contents), progress_bar, chunk_size)
 
     def _upload_dir(self, local_path: Path, remote_path: str, progress_bar: Optional[tqdm.tqdm] = None):
         _validate_path(remote_path)
-        for entry in os.listdir(local_path):
-            entry = Path(local_path / entry)
-            if not entry.is_symlink() and entry.is_dir():
-                self._upload_dir(entry, f"{remote_path}/{entry.name}", progress_bar)
-            else:
-                file_size = entry.stat().st_size
+        # `DirEntry` caches the file type from the directory listing, saving a stat per check
+        with os.scandir(local_path) as entries:
+            for entry in entries:
+                entry_remote_path = f"{remote_path}/{entry.name}"
+                if entry.is_dir(follow_symlinks=False):
+                    self._upload_dir(Path(entry.path), entry_remote_path, progress_bar)
+                elif entry.is_symlink():
+                    self.symlink(os.readlink(entry.path), entry_remote_path)
+                elif entry.is_file(follow_symlinks=False):
+                    file_size = entry.stat(follow_symlinks=False).st_size
+
+                    self._upload_file(Path(entry.path), entry_remote_path)
+
+                    if progress_bar:
+                        progress_bar.update(file_size)
+                else:
+                    raise IOError("Tried to upload a path that is neither a file nor a directory")
+
+    def _upload_file(
+            self,
+            local_path: Path,
+            remote_path: str,
+            chunk_size: int = DEFAULT_CHUNK_SIZE,
+            progress_bar=False
+    ):
+        with open(local_path, 'rb') as f:
+            file_len = os.fstat(f.fileno()).st_size
 
-                self.upload(entry, f"{remote_path}/{entry.name}")
+            def chunked():
+                # Every chunk is a new buffer, `write_stream` may still be sending the previous ones
+                for i in range(0, file_len, chunk_size):
+                    chunk = bytearray(min(chunk_size, file_len - i))
+                    if f.readinto(chunk) < len(chunk):
+                        raise IOError(f"{local_path} was truncated during upload")
+                    yield chunk
 
-                if progress_bar:
-                    progress_bar.update(file_size // 1024)
+            self.write_stream(chunked(), remote_path, file_len, progress_bar, chunk_size)
 
     def upload(
             self,
@@ -482,7 +1210,9 @@ class NfsConnection:
 
             whole_dir_size = _calc_dir_size(local_path)
             if progress_bar:
-                bar = tqdm.tqdm(total=ceil(whole_dir_size / 1024), unit='KB', desc=f"Uploading dir {local_path}")
+                bar = tqdm.tqdm(
+                    total=whole_dir_size, unit='B', unit_scale=True, unit_divisor=1024, desc=f"Uploading dir {local_path}"
+                )
             else:
                 bar = None
 
@@ -494,26 +1224,94 @@ class NfsConnection:
                 bar.close()
 
         elif local_path.is_file():
-            with open(local_path, 'rb') as f:
-                file_len = f.seek(0, 2)
-                f.seek(0)
-
-                def chunked():
-                    for i in range(0, file_len, chunk_size):
-                        yield f.read(chunk_size)
-
-                self.write_stream(chunked(), remote_path, file_len, progress_bar)
+            self._upload_file(local_path, remote_path, chunk_size, progress_bar)
 
         else:
             raise IOError("Tried to upload a path that is neither a file nor a directory")
 
 
+def _connection_pool_enabled() -> bool:
+    return not os.environ.get('AMPM_NO_CONNECTION_POOL')
+
+
+class NfsConnectionPool:
+    """
+    Shares `NfsConnection`s between `NfsRepo` instances, so an ampm invocation mounts every export once.
+    A connection only supports one request at a time, so every thread gets its own.
+    Set AMPM_NO_CONNECTION_POOL=1 to give every `NfsRepo` a private connection instead.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._connections: Dict[Tuple[str, str, int], NfsConnection] = {}
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    def executor(self) -> ThreadPoolExecutor:
+        """
+        Worker threads for running NFS operations in parallel. They're kept around (and so are their connections),
+        so that parallel operations don't pay for a new mount every time.
+        """
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=POOL_WORKERS, thread_name_prefix='ampm-nfs')
+            return self._executor
+
+    def get(self, host: str, remote_path: str) -> NfsConnection:
+        key = (host, remote_path, threading.get_ident())
+        with self._lock:
+            connection = self._connections.get(key)
+            if connection is None:
+                connection = self._connections[key] = NfsConnection(host, remote_path)
+            return connection
+
+    def forget_after_fork(self):
+        """
+        Drop all connections without touching their sockets, in a forked child they belong to the parent.
+        Another thread may have held the lock at fork time (and it never releases it in the child), so it's replaced.
+        """
+        self._lock = threading.Lock()
+        self._connections = {}
+        # The worker threads don't exist in a forked child
+        self._executor = None
+
+    def close(self):
+        with self._lock:
+            connections = list(self._connections.values())
+            self._connections.clear()
+
+        for connection in connections:
+            try:
+                # Don't wait on the (long) mount timeout if the server went away, just drop the sockets
+                connection._disconnect(unmount=False)
+            except Exception:
+                pass
+
+
+NFS_CONNECTION_POOL = NfsConnectionPool()
+atexit.register(NFS_CONNECTION_POOL.close)
+os.register_at_fork(after_in_child=NFS_CONNECTION_POOL.forget_after_fork)
+
+
 class NfsRepo(ArtifactRepo):
     def __init__(self, host: str, mount_path: str, repo_path: str):
         self.host = host
         self.mount_path = mount_path
         self.repo_path = repo_path
-        self.nfs = NfsConnection(host, mount_path)
+        self.use_pool = _connection_pool_enabled()
+        self._nfs: Optional[NfsConnection] = None
+        self._nfs_pid: Optional[int] = None
+
+    @property
+    def nfs(self) -> NfsConnection:
+        # A forked child can't use the parent's sockets, so it gets a connection of its own
+        if self._nfs is None or self._nfs_pid != os.getpid():
+            if not self.use_pool:
+                self._nfs = NfsConnection(self.host, self.mount_path)
+            else:
+                # Shared with other repos on the same export used by this thread
+                self._nfs = NFS_CONNECTION_POOL.get(self.host, self.mount_path)
+            self._nfs_pid = os.getpid()
+        return self._nfs
 
     @staticmethod
     def from_uri_part(uri_part: str) -> "NfsRepo":
@@ -541,7 +1339,7 @@ class NfsRepo(ArtifactRepo):
             print('Uploading metadata...', file=sys.stderr)
             tmp_remote_metadata_path = self.metadata_path_of(metadata.type, metadata.hash, '.toml.tmp')
             remote_metadata_path = self.metadata_path_of(metadata.type, metadata.hash)
-            self.nfs.write(toml.dumps(metadata.to_dict(with_mutable=True)).encode('utf-8'), tmp_remote_metadata_path)
+            self.nfs.write(metadata.to_toml(with_mutable=True), tmp_remote_metadata_path)
             self.nfs.rename(tmp_remote_metadata_path, remote_metadata_path)
 
             print('Done!', file=sys.stderr)
@@ -549,7 +1347,6 @@ class NfsRepo(ArtifactRepo):
     def lookup(self, query: ArtifactQuery) -> Iterable[ArtifactMetadata]:
         with self.nfs.connected():
             if query.is_exact:
-                # print('Downloading metadata')
                 with LOCAL_REPO.metadata_lockfile:
                     metadata_path = LOCAL_REPO.metadata_path_of(query.type, query.hash, '.toml')
                     tmp_metadata_path = Path(str(metadata_path) + '.tmp')
@@ -563,7 +1360,7 @@ class NfsRepo(ArtifactRepo):
                     except IOError:
                         raise QueryNotFoundError(query)
 
-                    metadata = ArtifactMetadata.from_dict(toml.load(tmp_metadata_path))
+                    metadata = ArtifactMetadata.from_dict(load_toml(tmp_metadata_path))
                     tmp_metadata_path.rename(metadata_path)
                     yield metadata
 
@@ -585,56 +1382,60 @@ class NfsRepo(ArtifactRepo):
         actual_hash = None
 
         with self.nfs.connected():
-            tmp_local_base_path.mkdir(parents=True, exist_ok=True)
+            # The parent was created above, and the rmtree made sure it doesn't exist
+            tmp_local_base_path.mkdir()
 
             if metadata.path_type == 'file' or metadata.path_type == 'dir':
+                # Directories with many files are fetched over several connections at once
                 if metadata.path_location:
-                    actual_hash = self.nfs.download(tmp_local_base_path / metadata.name, remote_base_path, progress_bar=True)
+                    actual_hash = self.nfs.download(
+                        tmp_local_base_path / metadata.name, remote_base_path, progress_bar=True, parallel=self.use_pool
+                    )
                 else:
-                    actual_hash = self.nfs.download(tmp_local_base_path, remote_base_path, progress_bar=True)
+                    actual_hash = self.nfs.download(
+                        tmp_local_base_path, remote_base_path, progress_bar=True, parallel=self.use_pool
+                    )
             elif metadata.path_type == 'gz':
-                decompressor = subprocess.Popen(['gzip', '-d'], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
-                hasher = hashlib.sha256(b'')
-
-                def out_reader(tmp_local_file_path):
-                    with open(tmp_local_file_path, 'wb') as output_file:
-                        while True:
-                            chunk = decompressor.stdout.read(1024 * 1024)
-                            if len(chunk):
-                                output_file.write(chunk)
-                            else:
-                                break
-
-                def in_writer():
-                    for chunk in self.nfs.read_stream(remote_path, progress_bar=True):
-                        decompressor.stdin.write(chunk)
-                        hasher.update(chunk)
-                    decompressor.stdin.close()
+                hasher = hashlib.sha256()
 
-                out_reader_thread = threading.Thread(target=out_reader, args=((tmp_local_base_path / metadata.name),))
-                in_writer_thread = threading.Thread(target=in_writer)
-                out_reader_thread.start()
-                in_writer_thread.start()
+                def hashed(chunks):
+                    for chunk in chunks:
+                        hasher.update(chunk)
+                        yield chunk
 
-                out_reader_thread.join()
-                in_writer_thread.join()
+                # NFS reads happen on the prefetch thread while zlib (which releases the GIL) inflates on this one.
+                # Closed explicitly, so a decompression or write error stops the prefetch thread right away.
+                with contextlib.closing(_prefetch(self.nfs.read_stream(remote_path, progress_bar=True))) as compressed, \
+                        open(tmp_local_base_path / metadata.name, 'wb') as output_file:
+                    for chunk in _gunzip(hashed(compressed)):
+                        output_file.write(chunk)
 
                 actual_hash = hasher.hexdigest()
             elif metadata.path_type == 'tar.gz':
-                tmp_local_path.mkdir(parents=True)
+                tmp_local_path.mkdir()
                 decompressor = subprocess.Popen(
                     ['tar', '--delay-directory-restore', '-xz'],
                     stdin=subprocess.PIPE,
                     stdout=subprocess.PIPE,
                     cwd=str(tmp_local_path),
                 )
-                hasher = hashlib.sha256(b'')
-
-                for chunk in self.nfs.read_stream(remote_path, progress_bar=True):
-                    decompressor.stdin.write(chunk)
-                    hasher.update(chunk)
-                decompressor.stdin.close()
-                decompressor.wait()
+                _enlarge_pipe(decompressor.stdin)
+                hasher = hashlib.sha256()
+
+                # Keep reading from NFS while tar is busy decompressing
+                try:
+                    with contextlib.closing(_prefetch(self.nfs.read_stream(remote_path, progress_bar=True))) as chunks:
+                        for chunk in chunks:
+                            decompressor.stdin.write(chunk)
+                            hasher.update(chunk)
+                    decompressor.stdin.close()
+                finally:
+                    if not decompressor.stdin.closed:
+                        # Failed midway, don't leave tar waiting for the rest of its input
+                        decompressor.kill()
+                        with contextlib.suppress(BrokenPipeError):
+                            decompressor.stdin.close()
+                    decompressor.wait()
 
                 actual_hash = hasher.hexdigest()
             else:
@@ -650,9 +1451,23 @@ class NfsRepo(ArtifactRepo):
 
     def download_metadata_for_type(self, artifact_type: str):
         base_path = self.metadata_path_of(artifact_type, '', '')
+
+        def download_one(nfs: NfsConnection, full_type: str, artifact_hash: str):
+            local_path = LOCAL_REPO.metadata_path_of(full_type, artifact_hash, '.toml')
+            tmp_local_path = LOCAL_REPO.metadata_path_of(full_type, artifact_hash, '.toml.tmp')
+            tmp_local_path.parent.mkdir(parents=True, exist_ok=True)
+            nfs.download(tmp_local_path, self.metadata_path_of(full_type, artifact_hash))
+            tmp_local_path.rename(local_path)
+
+        def download_one_pooled(full_type: str, artifact_hash: str):
+            # Runs on a pool worker, which has its own connection
+            with NFS_CONNECTION_POOL.get(self.host, self.mount_path).connected() as nfs:
+                download_one(nfs, full_type, artifact_hash)
+
         try:
             with self.nfs.connected():
                 with LOCAL_REPO.metadata_lockfile:
+                    missing = []
                     for metadata_path in self.nfs.walk_files(base_path):
                         matches = re.match(r'(.*)/([a-z0-9]{32})\.toml$', metadata_path[len(base_path):])
                         if matches:
@@ -661,14 +1476,23 @@ class NfsRepo(ArtifactRepo):
                             local_path = LOCAL_REPO.metadata_path_of(artifact_type + type_extra, artifact_hash, '.toml')
                             if local_path.exists():
                                 continue
-                            tmp_local_path = LOCAL_REPO.metadata_path_of(
-                                artifact_type + type_extra,
-                                artifact_hash,
-                                '.toml.tmp',
-                            )
-                            tmp_local_path.parent.mkdir(parents=True, exist_ok=True)
-                            self.nfs.download(tmp_local_path, self.metadata_path_of(artifact_type + type_extra, artifact_hash))
-                            tmp_local_path.rename(local_path)
+                            missing.append((artifact_type + type_extra, artifact_hash))
+
+                    if not self.use_pool:
+                        for m in missing:
+                            download_one(self.nfs, *m)
+                        return
+
+                    # Metadata files are tiny, so this is bound by round trips, fetch them in parallel
+                    futures = [NFS_CONNECTION_POOL.executor().submit(download_one_pooled, *m) for m in missing]
+                    try:
+                        for future in futures:
+                            future.result()
+                    finally:
+                        # On error, don't leave workers writing into the metadata dir after we release the lock
+                        for future in futures:
+                            future.cancel()
+                        concurrent.futures.wait(futures)
         except (ConnectionError, PermissionError):
             raise
         except IOError:
@@ -680,8 +1504,9 @@ class NfsRepo(ArtifactRepo):
         _validate_path(remote_path)
 
         with self.nfs.connected():
-            hasher = hashlib.sha256(b'')
-            for chunk in self.nfs.read_stream(remote_path, progress_bar):
+            hasher = hashlib.sha256()
+            # Ask for large reads, the server clamps them to its own maximum if needed
+            for chunk in self.nfs.read_stream(remote_path, chunk_size=HASH_CHUNK_SIZE, progress_bar=progress_bar):
                 hasher.update(chunk)
             return hasher.hexdigest()
 
@@ -729,6 +1554,9 @@ class NfsRepo(ArtifactRepo):
             print(f'Artifact {identifier} not found', file=sys.stderr)
             return False
 
+        # Looked up metadata may be shared (e.g. cached by the local repo), so edit a copy
+        metadata = dataclasses.replace(metadata, mutable=copy.deepcopy(metadata.mutable))
+
         # Apply changes to mutable attrs
         mut_attrs = metadata.mutable.setdefault('attributes', {})
         attrs_to_change = {k: v for k, v in attr.items() if not k.startswith('-')}
@@ -765,24 +1593,38 @@ class NfsRepo(ArtifactRepo):
             )
             exit(1)
 
+        # Unique, so there's never a leftover temp file that has to be removed first
+        tmp_remote_metadata_path = self.metadata_path_of(
+            metadata.type, metadata.hash, f'.toml.tmp.{randbytes(4).hex()}'
+        )
+        remote_metadata_bak_path = self.metadata_path_of(metadata.type, metadata.hash, '.toml.bak')
+        remote_metadata_path = self.metadata_path_of(metadata.type, metadata.hash)
+
         with self.nfs.connected():
             print('Uploading metadata...', file=sys.stderr)
-            tmp_remote_metadata_path = self.metadata_path_of(metadata.type, metadata.hash, '.toml.tmp')
-            remote_metadata_bak_path = self.metadata_path_of(metadata.type, metadata.hash, '.toml.bak')
-            remote_metadata_path = self.metadata_path_of(metadata.type, metadata.hash)
-
             try:
-                self.nfs.remove(remote_metadata_bak_path)
-            except IOError:
-                pass  # No backup, moving on
-
-            try:
-                self.nfs.remove(tmp_remote_metadata_path)
-            except IOError:
-                pass  # No temp fille, moving on
-
-            self.nfs.write(toml.dumps(metadata.to_dict(with_mutable=True)).encode('utf-8'), tmp_remote_metadata_path)
-            self.nfs.rename(remote_metadata_path, remote_metadata_bak_path)
-            self.nfs.rename(tmp_remote_metadata_path, remote_metadata_path)
+                self.nfs.write(metadata.to_toml(with_mutable=True), tmp_remote_metadata_path)
+
+                try:
+                    self.nfs.remove(remote_metadata_bak_path)
+                except IOError:
+                    pass  # No backup, moving on
+
+                try:
+                    # Unlike renaming it away, this never leaves the metadata path missing
+                    self.nfs.link(remote_metadata_path, remote_metadata_bak_path)
+                except IOError:
+                    # Server doesn't support hard links
+                    self.nfs.rename(remote_metadata_path, remote_metadata_bak_path)
+
+                # Atomically replaces the old metadata
+                self.nfs.rename(tmp_remote_metadata_path, remote_metadata_path)
+            except BaseException:
+                # Nobody else knows the unique name, so it would stay around forever
+                try:
+                    self.nfs.remove(tmp_remote_metadata_path)
+                except Exception:
+                    pass  # Never created, or the connection is gone
+                raise
 
             print('Done!', file=sys.stderr)
@@ -1,14 +1,21 @@
-import random
+import fcntl
 import threading
 import atexit
 import hashlib
 import os
+import queue
 import sys
-import time
-from io import TextIOWrapper
+from io import BufferedIOBase
 from pathlib import Path
 from typing import Optional
 
+try:
+    import tomllib
+except ImportError:
+    # Python < 3.11
+    tomllib = None
+    import toml
+
 
 def _calc_dir_size(path: Path) -> int:
     """
@@ -18,26 +25,116 @@ def _calc_dir_size(path: Path) -> int:
     :return: Sum of all file sizes inside the directory.
     """
     total_size = 0
-    for dirpath, _dirnames, filenames in os.walk(path):
-        for f in filenames:
-            fp = os.path.join(dirpath, f)
-            try:
-                total_size += os.path.getsize(fp)
-            except FileNotFoundError:
-                pass
+    stack = [path]
+    while stack:
+        with os.scandir(stack.pop()) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                    continue
+                try:
+                    total_size += entry.stat(follow_symlinks=False).st_size
+                except FileNotFoundError:
+                    pass
     return total_size
 
 
+HASH_CHUNK_SIZE = 8 * 1024 * 1024
+HASH_BUFFERS = 3
+
+
 def hash_local_file(local_path: Path) -> str:
-    hasher = hashlib.sha256(b'')
-    with local_path.open('rb') as fd:
-        while True:
-            chunk = fd.read(1024 * 1024)
-            if len(chunk) == 0:
-                break
-            hasher.update(chunk)
+    """
+    Calculate the SHA-256 of a file.
+
+    :param local_path: Path to the file.
+    :return: Hex digest of the file contents.
+    """
+    if hasattr(hashlib, 'file_digest'):
+        # Python 3.11+: The read/update loop runs in C
+        with local_path.open('rb', buffering=0) as fd:
+            return hashlib.file_digest(fd, 'sha256').hexdigest()
+    return _hash_local_file_pipelined(local_path)
+
+
+def _hash_local_file_pipelined(local_path: Path) -> str:
+    """
+    Calculate the SHA-256 of a file, for Python versions without `hashlib.file_digest`.
+    Reading is done on a separate thread, so the disk (or NFS) and the hashing are busy at the same time.
+    """
+    hasher = hashlib.sha256()
+    free_buffers = queue.Queue()
+    full_buffers = queue.Queue()
+    for _ in range(HASH_BUFFERS):
+        free_buffers.put(bytearray(HASH_CHUNK_SIZE))
+
+    def reader(fd):
+        try:
+            while True:
+                buf = free_buffers.get()
+                if buf is None:
+                    return  # Hashing failed, stop reading
+                length = fd.readinto(buf)
+                full_buffers.put((buf, length))
+                if not length:
+                    return
+        except BaseException as e:
+            full_buffers.put((e, 0))
+
+    with local_path.open('rb', buffering=0) as fd:
+        reader_thread = threading.Thread(target=reader, args=(fd,), daemon=True)
+        reader_thread.start()
+        try:
+            while True:
+                buf, length = full_buffers.get()
+                if isinstance(buf, BaseException):
+                    raise buf
+                if not length:
+                    break
+                with memoryview(buf) as view:
+                    hasher.update(view[:length])
+                free_buffers.put(buf)
+        finally:
+            free_buffers.put(None)
+            reader_thread.join()
+
+    return hasher.hexdigest()
+
+
+class HashingWriter:
+    """
+    Wraps a writable binary file, calculating the SHA-256 of everything written through it.
+    Used to hash files while creating them, instead of reading them again afterwards.
+    """
 
-        return hasher.hexdigest()
+    def __init__(self, fd: BufferedIOBase):
+        self.fd = fd
+        # `gzip` and `tarfile` put the file name in the gzip header
+        self.name = getattr(fd, 'name', '')
+        self.hasher = hashlib.sha256()
+
+    def write(self, data) -> int:
+        self.hasher.update(data)
+        return self.fd.write(data)
+
+    def flush(self):
+        self.fd.flush()
+
+    def hexdigest(self) -> str:
+        return self.hasher.hexdigest()
+
+
+def load_toml(path: Path) -> dict:
+    """
+    Parse a TOML file, using the standard library's parser where available (it's faster than the `toml` package).
+
+    :param path: Path to the file.
+    :return: The parsed document.
+    """
+    if tomllib is None:
+        return toml.load(path)
+    with path.open('rb') as f:
+        return tomllib.load(f)
 
 
 def randbytes(length: int) -> bytes:
@@ -47,8 +144,8 @@ def randbytes(length: int) -> bytes:
     :param length: Length of the random bytes object.
     :return: Random bytes object.
     """
-    import random
-    return bytes(random.getrandbits(8) for _ in range(length))
+    # Used for temp file names, so this should be unpredictable (and it's a single syscall)
+    return os.urandom(length)
 
 
 def remove_atexit(path: Path):
@@ -58,76 +155,52 @@ def remove_atexit(path: Path):
 
 
 class LockFile:
+    """
+    Inter-process lock, using `flock` on a file.
+    The kernel releases it when the holder exits (even abruptly), so stale locks don't need to be detected.
+    """
+
     def __init__(self, path: Path, description: str):
         self.path = path
         self.description = description
-        self.lockfile: Optional[TextIOWrapper] = None
-
-        self._updater_thread_stop = threading.Event()
-        self._updater_thread = None
+        self.fd: Optional[int] = None
 
     def take(self):
-        waited_for = 0.0
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        waiting = False
         while True:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o666)
             try:
-                self.path.parent.mkdir(parents=True, exist_ok=True)
-                self.lockfile = self.path.open('x')
-                self.refresh()
-                break
-            except FileExistsError:
-                strikes = 0
-                last_locktime = ''
-                while True:
-                    try:
-                        new_locktime = self.path.read_text() or '0'
-                        if new_locktime != last_locktime:
-                            last_locktime = new_locktime
-                            strikes = 0
-                        else:
-                            strikes += 1
-                            # After about 10 seconds, we assume the process that locked the file died abruptly
-                            if strikes > 20:
-                                print(f'INFO: ampm that locked the download of {self.description} seems to be dead, force unlocking', file=sys.stderr)
-                                self.path.unlink(missing_ok=True)
-                                break
-
-                        print(f'INFO: [{waited_for:0.1f}s] Waiting for lockfile on {self.description}', file=sys.stderr)
-                        wait_for = 0.5 + random.random() / 4
-                        time.sleep(wait_for)
-                        waited_for += wait_for
-                    except FileNotFoundError:
-                        break  # lockfile was deleted, we can take it
-
-    def refresh(self):
-        assert self.lockfile, 'Lockfile not taken'
-        self.lockfile.seek(0)
-        self.lockfile.truncate(0)
-        self.lockfile.write(f'{time.time():0.2f}')
-        self.lockfile.flush()
-
-    def take_and_spawn_refresher(self):
-        self.take()
-
-        def lockfile_updater():
-            while True:
-                self.refresh()
-                if self._updater_thread_stop.wait(1):
-                    break
-
-        self._updater_thread_stop.clear()
-        self._updater_thread = threading.Thread(target=lockfile_updater, daemon=True)
-        self._updater_thread.start()
-
-    def release_and_kill_refresher(self):
-        self._updater_thread_stop.set()
-        self._updater_thread.join()
-
-        self.lockfile.close()
-        self.lockfile = None
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    if not waiting:
+                        print(f'INFO: Waiting for lockfile on {self.description}', file=sys.stderr)
+                        waiting = True
+                    fcntl.flock(fd, fcntl.LOCK_EX)
+
+                # The previous holder deletes the file when releasing it, so make sure we locked the current one
+                try:
+                    is_current = os.path.samestat(os.fstat(fd), os.stat(self.path))
+                except FileNotFoundError:
+                    is_current = False
+                if is_current:
+                    self.fd = fd
+                    return
+            except BaseException:
+                os.close(fd)
+                raise
+            os.close(fd)
+
+    def release(self):
+        assert self.fd is not None, 'Lockfile not taken'
+        # Deleted while still locked, anyone waiting on it will notice and retry with a new file
         self.path.unlink()
+        os.close(self.fd)
+        self.fd = None
 
     def __enter__(self):
-        self.take_and_spawn_refresher()
+        self.take()
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self.release_and_kill_refresher()
+        self.release()
@@ -1,54 +1,79 @@
-import dataclasses
+import functools
 import re
-from typing import List, Iterator
+from collections import ChainMap
+from typing import List, Iterator, Mapping
 
+_MARKER_RE = re.compile(r"\{\{([a-zA-Z_][a-zA-Z0-9_ ]+)}}")
 
-@dataclasses.dataclass
-class Span:
-    contents: str
-    type: str
+# Compiled templates are lists of tuples:
+#   (_TEXT, text)
+#   (_SUBST, key)
+#   (_FOREACH, key, inner tokens)
+_TEXT = 0
+_SUBST = 1
+_FOREACH = 2
+
+_END = object()
 
 
 def format_page(template: str, context: dict) -> Iterator[str]:
+    return _render(compile_template(template), context)
+
+
+@functools.lru_cache(maxsize=8)
+def compile_template(template: str) -> List[tuple]:
+    tokens = []
+    # (foreach marker, tokens of the enclosing block) for every open foreach
+    open_blocks = []
     curr_idx = 0
-    spans = []
-    for marker in re.finditer(r"\{\{([a-zA-Z_][a-zA-Z0-9_ ]+)}}", template):
-        spans.append(Span(template[curr_idx : marker.start()], "text"))
-        spans.append(Span(marker.group(1), "marker"))
+    for marker in _MARKER_RE.finditer(template):
+        if marker.start() != curr_idx:
+            tokens.append((_TEXT, template[curr_idx : marker.start()]))
         curr_idx = marker.end()
-    spans.append(Span(template[curr_idx:], "text"))
 
-    return _format_span_list(spans, context)
+        contents = marker.group(1)
+        if contents.startswith("foreach "):
+            inner_tokens = []
+            tokens.append((_FOREACH, contents[len("foreach ") :], inner_tokens))
+            open_blocks.append((contents, tokens))
+            tokens = inner_tokens
+        elif open_blocks and contents == "end " + open_blocks[-1][0]:
+            tokens = open_blocks.pop()[1]
+        elif " " not in contents:
+            tokens.append((_SUBST, contents))
+        else:
+            raise ValueError(f"Invalid marker: `{contents}`")
 
+    if open_blocks:
+        raise ValueError(f"Missing marker: `end {open_blocks[-1][0]}`")
+    if curr_idx != len(template):
+        tokens.append((_TEXT, template[curr_idx:]))
+    return tokens
 
-def _format_span_list(spans: List[Span], context: dict):
-    spans = iter(spans)
+
+def _render(tokens: List[tuple], context: Mapping) -> Iterator[str]:
+    # One entry per foreach we're inside of: (tokens and context to resume after it, items left, loop body)
+    loops = []
+    tokens = iter(tokens)
     while True:
-        try:
-            span = next(spans)
-        except StopIteration:
-            break
-
-        if span.type == "text":
-            yield span.contents
-        elif span.type == "marker":
-            if span.contents.startswith("foreach "):
-                inner_spans = []
-                while True:
-                    inner_span = next(spans)
-                    if (
-                        inner_span.type == "marker"
-                        and inner_span.contents == "end " + span.contents
-                    ):
-                        break
-                    inner_spans.append(inner_span)
-
-                key = span.contents[len("foreach ") :]
-                for item in context[key]:
-                    merged = context.copy()
-                    merged.update(item)
-                    yield from _format_span_list(inner_spans, merged)
-            elif " " not in span.contents:
-                yield context[span.contents]
+        for token in tokens:
+            if token[0] == _TEXT:
+                yield token[1]
+            elif token[0] == _SUBST:
+                yield context[token[1]]
             else:
-                raise ValueError(f"Invalid marker: `{span.contents}`")
+                loops.append((tokens, context, iter(context[token[1]]), token[2]))
+                break
+        else:
+            if not loops:
+                return
+
+        # Either entered a loop or finished an iteration, go to the next item
+        outer_tokens, outer_context, items, body = loops[-1]
+        item = next(items, _END)
+        if item is _END:
+            loops.pop()
+            tokens, context = outer_tokens, outer_context
+        else:
+            # Item keys shadow the outer context, without copying it
+            tokens, context = iter(body), ChainMap(item, outer_context)
@@ -2,4 +2,9 @@
 
 set -ex
 
-PYTHONPATH='vendor:.' pytest tests/ -rP "$@"
\ No newline at end of file
+# Spread the tests over all CPUs if pytest-xdist is installed
+if python3 -c 'import xdist' 2>/dev/null; then
+  set -- -n auto --dist=loadgroup "$@"
+fi
+
+PYTHONPATH='vendor:.' pytest tests/ -rP --runslow "$@"
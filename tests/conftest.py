@@ -1,12 +1,16 @@
+import os
 import shutil
+import socket
 import subprocess
+import threading
 import time
 
 import pytest
+import ampm.repo.nfs
 from pathlib import Path
 from ampm.repo.local import LOCAL_REPO
 from ampm.repo.nfs import NfsRepo
-from ampm.utils import randbytes
+from ampm.utils import LockFile, randbytes
 
 BIG_FILE_SIZE_MIB = 100
 
@@ -58,16 +62,145 @@ def big_file(tmp_path_factory: "TempPathFactory"):
             # Wrong size, recreate
             tmpfile_path.unlink()
 
-    with Path('/dev/urandom').open('rb') as rng:
-        with tmpfile_path.open('wb') as fd:
-            for _ in range(BIG_FILE_SIZE_MIB):
-                fd.write(rng.read(1024*1024))  # 1 MiB per chunk
+    # Repeat a single random block. Its odd size keeps it from lining up with any transfer chunk size,
+    # so chunks that end up in the wrong place still make the contents differ.
+    size = BIG_FILE_SIZE_MIB * 1024 * 1024
+    pattern = randbytes(1024 * 1024 + 7)
+    with tmpfile_path.open('wb') as fd:
+        os.posix_fallocate(fd.fileno(), 0, size)
+        for offset in range(0, size, len(pattern)):
+            fd.write(pattern[:size - offset])
 
     yield tmpfile_path
 
 
+def _wait_for_nfs_server(host: str, server: subprocess.Popen, ports, timeout: float = 10):
+    """Wait until the mount and NFS services are accepting connections"""
+    deadline = time.monotonic() + timeout
+    while True:
+        if server.poll() is not None:
+            raise RuntimeError(f"NFS server exited with code {server.returncode}")
+        try:
+            for port in ports:
+                socket.create_connection((host, port), timeout=1).close()
+            return
+        except OSError:
+            pass  # Not up yet
+        if time.monotonic() > deadline:
+            raise RuntimeError("NFS server didn't come up")
+        time.sleep(0.01)
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _recv_exactly(sock: socket.socket, size: int) -> bytes:
+    data = bytearray(size)
+    view = memoryview(data)
+    while view:
+        received = sock.recv_into(view)
+        if not received:
+            raise ConnectionError("Connection closed")
+        view = view[received:]
+    return bytes(data)
+
+
+def _recv_rpc_record(sock: socket.socket) -> bytes:
+    """Receives a single record-marked RPC message (RFC 5531, section 11), including its fragment headers"""
+    record = bytearray()
+    last_fragment = False
+    while not last_fragment:
+        header = _recv_exactly(sock, 4)
+        fragment_header = int.from_bytes(header, 'big')
+        last_fragment = bool(fragment_header & 0x80000000)
+        record += header + _recv_exactly(sock, fragment_header & 0x7fffffff)
+    return bytes(record)
+
+
+class _SerializingRpcProxy:
+    """
+    unfsd mixes up (and sometimes crashes on) requests arriving on several connections at once.
+    This sits in front of one of its ports and forwards the requests of all client connections over a single one,
+    one at a time, so the client keeps all of its connections and workers.
+    """
+
+    def __init__(self, host: str, upstream_port: int):
+        self.host = host
+        self.upstream_port = upstream_port
+        self.upstream = None
+        self.lock = threading.Lock()
+        self.listener = socket.create_server((host, 0))
+        self.port = self.listener.getsockname()[1]
+        threading.Thread(target=self._accept_loop, name='rpc-proxy', daemon=True).start()
+
+    def _accept_loop(self):
+        while True:
+            try:
+                client, _ = self.listener.accept()
+            except OSError:
+                return  # Closed
+            threading.Thread(target=self._serve, args=(client,), name='rpc-proxy-conn', daemon=True).start()
+
+    def _serve(self, client: socket.socket):
+        with client:
+            while True:
+                try:
+                    request = _recv_rpc_record(client)
+                except OSError:
+                    return  # The client disconnected
+                with self.lock:
+                    try:
+                        if self.upstream is None:
+                            self.upstream = socket.create_connection((self.host, self.upstream_port))
+                        self.upstream.sendall(request)
+                        reply = _recv_rpc_record(self.upstream)
+                    except OSError:
+                        if self.upstream is not None:
+                            self.upstream.close()
+                            self.upstream = None
+                        return  # Drop the client too, so it notices
+                try:
+                    client.sendall(reply)
+                except OSError:
+                    return
+
+    def close(self):
+        self.listener.close()
+        with self.lock:
+            if self.upstream is not None:
+                self.upstream.close()
+
+
+def pytest_addoption(parser):
+    parser.addoption('--runslow', action='store_true', help='Also run the slow, I/O heavy tests')
+
+
+def pytest_configure(config):
+    # Registered by pytest-xdist when it's installed, the suite still runs serially without it
+    config.addinivalue_line('markers', 'xdist_group(name): run all tests of the group on the same xdist worker')
+    config.addinivalue_line('markers', 'slow: long-running, I/O heavy test, only runs with --runslow')
+
+    workerinput = getattr(config, 'workerinput', None)
+    if workerinput is not None:
+        # Tests wipe the local repo, so every xdist worker gets its own
+        LOCAL_REPO.path = LOCAL_REPO.path / 'xdist' / workerinput['workerid']
+        LOCAL_REPO.metadata_lockfile = LockFile(LOCAL_REPO.path / 'metadata.lock', 'metadata lock')
+
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption('--runslow'):
+        return
+    skip_slow = pytest.mark.skip(reason='Slow test, pass --runslow to run it')
+    for item in items:
+        if 'slow' in item.keywords:
+            item.add_marker(skip_slow)
+
+
 @pytest.fixture(scope='session')
-def nfs_server(tmp_path_factory: "TempPathFactory"):
+def nfs_server(request, tmp_path_factory: "TempPathFactory"):
     print("Starting NFS server")
     tmp_path = tmp_path_factory.mktemp('nfs_tests_')
 
@@ -77,17 +210,37 @@ def nfs_server(tmp_path_factory: "TempPathFactory"):
     exports = tmp_path / f'exports'
     exports.write_text(f'{str(nfs_root)} 127.0.0.1(rw,insecure)')
 
-    server = subprocess.Popen([
+    # Every server (one per xdist worker) gets its own ports, instead of the default ports and portmap registrations
+    host = '127.0.0.1'
+    ports = (_free_port(), _free_port())
+    args = [
         Path(__file__).parent / 'unfsd',
         '-d',  # Dont daemonize
         '-s',  # Single-user mode
-        '-e', str(exports)  # Export file
-    ])
-    time.sleep(0.5)
-
+        '-e', str(exports),  # Export file
+        '-p',  # Don't register with portmap
+        '-t',  # TCP only
+        '-m', str(ports[0]),  # Mount port
+        '-n', str(ports[1]),  # NFS port
+    ]
+    output = None
+    if hasattr(request.config, 'workerinput'):
+        # Nobody reads the worker's stdout, writing to it would eventually kill unfsd
+        output = (tmp_path / 'unfsd.log').open('wb')
+
+    server = subprocess.Popen(args, stdout=output, stderr=subprocess.STDOUT if output else None)
+    if output:
+        output.close()
+    proxies = []
     try:
-        yield {'root': nfs_root, 'host': '127.0.0.1'}
+        _wait_for_nfs_server(host, server, ports)
+        # The client connects through the proxies, with as many connections and workers as it would in production
+        proxies = [_SerializingRpcProxy(host, port) for port in ports]
+        ampm.repo.nfs._service_ports[host] = tuple(proxy.port for proxy in proxies)
+        yield {'root': nfs_root, 'host': host}
     finally:
+        for proxy in proxies:
+            proxy.close()
         server.kill()
 
 
@@ -1,25 +1,37 @@
 import json
 import gzip
 import multiprocessing
+import os
 import re
-import subprocess
 import tarfile
+import threading
 import time
+import zlib
 import pytest
 import ampm.cli
+import ampm.repo.nfs
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Dict, Optional
+from typing import Dict, List, Optional
 from click.testing import CliRunner
+from ampm.repo.base import ArtifactQuery, ArtifactRepo, RepoGroup
+from ampm.utils import hash_local_file
+
+# `<type>:<hash>`, as printed by `ampm upload`
+_UPLOAD_OUTPUT_RE = re.compile(r'^([^:]+):([a-z0-9]{32})$')
 
 
 def assert_files_identical(path_a: Path, path_b: Path):
-    sum_a = subprocess.check_output(['sha256sum', str(path_a)]).partition(b' ')[0]
-    sum_b = subprocess.check_output(['sha256sum', str(path_b)]).partition(b' ')[0]
-    assert sum_a == sum_b, f'Files were not identical:\n    {sum_a.decode()}  {str(path_a)}\n != {sum_b.decode()}  {str(path_b)}\n'
+    # Hash both at once, so reading one file overlaps with hashing the other
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        sum_a, sum_b = executor.map(hash_local_file, (path_a, path_b))
+    assert sum_a == sum_b, f'Files were not identical:\n    {sum_a}  {str(path_a)}\n != {sum_b}  {str(path_b)}\n'
 
 
 @pytest.fixture()
 def upload(nfs_repo_uri):
+    runner = CliRunner(mix_stderr=False, env={'AMPM_SERVER': nfs_repo_uri})
+
     def _upload(
             local_path: Optional[str],
             artifact_type: str,
@@ -29,7 +41,6 @@ def upload(nfs_repo_uri):
     ) -> str:
         if attributes is None:
             attributes = {}
-        runner = CliRunner(mix_stderr=False, env={'AMPM_SERVER': nfs_repo_uri})
 
         args = ['upload', '--type', artifact_type, '--compressed' if compressed else '--uncompressed']
         if local_path:
@@ -43,16 +54,17 @@ def upload(nfs_repo_uri):
         formatted_output = f'== STDERR ==\n{result.stderr}\n\n== STDOUT ==\n{result.stdout}'
         assert result.exit_code == 0, formatted_output
 
-        artifact_hash = re.match(f'^{artifact_type}:([a-z0-9]{{32}})$', result.stdout.strip())
-        assert artifact_hash is not None, f'Unexpected output:\n{formatted_output}'
-        return artifact_hash.group(1)
+        match = _UPLOAD_OUTPUT_RE.match(result.stdout.strip())
+        assert match is not None and match.group(1) == artifact_type, f'Unexpected output:\n{formatted_output}'
+        return match.group(2)
     return _upload
 
 
 @pytest.fixture()
 def download(nfs_repo_uri):
+    runner = CliRunner(mix_stderr=False, env={'AMPM_SERVER': nfs_repo_uri})
+
     def _download(identifier: str, attributes: Dict[str, str]) -> Path:
-        runner = CliRunner(mix_stderr=False, env={'AMPM_SERVER': nfs_repo_uri})
         result = runner.invoke(
             ampm.cli.cli,
             ['get', identifier] + [f'--attr={k}={v}' for k, v in attributes.items()],
@@ -67,11 +79,48 @@ def download(nfs_repo_uri):
     return _download
 
 
+@pytest.fixture()
+def upload_many(nfs_repo_uri, tmp_path: Path):
+    runner = CliRunner(mix_stderr=False, env={'AMPM_SERVER': nfs_repo_uri})
+
+    def _upload_many(records: List[dict]) -> List[str]:
+        manifest_path = tmp_path / 'manifest.jsonl'
+        manifest_path.write_text(''.join(json.dumps(record) + '\n' for record in records))
+
+        result = runner.invoke(ampm.cli.cli, ['upload-many', '--manifest', str(manifest_path)], catch_exceptions=False)
+        formatted_output = f'== STDERR ==\n{result.stderr}\n\n== STDOUT ==\n{result.stdout}'
+        assert result.exit_code == 0, formatted_output
+
+        artifact_hashes = []
+        for record, line in zip(records, result.stdout.splitlines()):
+            match = _UPLOAD_OUTPUT_RE.match(line)
+            assert match is not None and match.group(1) == record['type'], f'Unexpected output:\n{formatted_output}'
+            artifact_hashes.append(match.group(2))
+        assert len(artifact_hashes) == len(records), f'Missing output lines:\n{formatted_output}'
+        return artifact_hashes
+    return _upload_many
+
+
+@pytest.fixture()
+def download_direct(nfs_repo_uri):
+    """Like `download`, but without the command line parsing and output capturing, for tests that download a lot"""
+    repos = RepoGroup(remote_uri=nfs_repo_uri)
+
+    def _download_direct(identifier: str, attributes: Dict[str, str]) -> Path:
+        artifact_path, _metadata = repos.get_single(ArtifactQuery(identifier, attributes))
+        assert artifact_path.exists(), f'Downloaded artifact doesn\'t exist: {artifact_path}'
+        return artifact_path
+    return _download_direct
+
+
 @pytest.fixture()
 def list_(nfs_repo_uri):
+    runner = CliRunner(mix_stderr=False, env={'AMPM_SERVER': nfs_repo_uri})
+
     def _list_(identifier: str, attributes: Dict[str, str], offline=False, override_server=None) -> dict:
-        runner = CliRunner(mix_stderr=False, env={'AMPM_SERVER': override_server or nfs_repo_uri})
-        result = runner.invoke(
+        list_runner = runner if override_server is None \
+            else CliRunner(mix_stderr=False, env={'AMPM_SERVER': override_server})
+        result = list_runner.invoke(
             ampm.cli.cli,
             (['--offline'] if offline else []) + ['list', identifier, '--format=json'] + [f'--attr={k}={v}' for k, v in attributes.items()],
             catch_exceptions=False
@@ -85,8 +134,9 @@ def list_(nfs_repo_uri):
 
 @pytest.fixture()
 def remote_rm(nfs_repo_uri):
+    runner = CliRunner(mix_stderr=False, env={'AMPM_SERVER': nfs_repo_uri})
+
     def _remote_rm(identifier: str, accept: bool) -> Path:
-        runner = CliRunner(mix_stderr=False, env={'AMPM_SERVER': nfs_repo_uri})
         result = runner.invoke(
             ampm.cli.cli,
             ['remote-rm', identifier]
@@ -100,10 +150,11 @@ def remote_rm(nfs_repo_uri):
 
 @pytest.fixture()
 def edit(nfs_repo_uri):
+    runner = CliRunner(mix_stderr=False, env={'AMPM_SERVER': nfs_repo_uri})
+
     def _edit(identifier: str, attributes=None) -> Path:
         if attributes is None:
             attributes = {}
-        runner = CliRunner(mix_stderr=False, env={'AMPM_SERVER': nfs_repo_uri})
         result = runner.invoke(
             ampm.cli.cli,
             ['edit', identifier] + [f'--attr={k}={v}' for k, v in attributes.items()],
@@ -399,7 +450,7 @@ def test_download_external_archive(nfs_mount_path: Path, clean_repos, upload, do
 
 
 @pytest.mark.parametrize('filter_type', ['num', 'date', 'semver'])
-def test_attr_filters(clean_repos, upload, list_, filter_type):
+def test_attr_filters(clean_repos, upload_many, list_, filter_type):
     _ = clean_repos
 
     sample_data = {
@@ -445,14 +496,10 @@ def test_attr_filters(clean_repos, upload, list_, filter_type):
         },
     }
 
-    artifact_hashes = []
-    for data in sample_data[filter_type]:
-        artifact_hashes.append(upload(
-            'tests/dummy_data/foobar.txt',
-            artifact_type='foo',
-            compressed=False,
-            attributes={'attr': data}
-        ))
+    upload_many([
+        {'local_path': 'tests/dummy_data/foobar.txt', 'type': 'foo', 'compressed': False, 'attr': {'attr': data}}
+        for data in sample_data[filter_type]
+    ])
 
     def do_test(query):
         return sorted(a['attributes']['attr'] for a in list_('foo', {'attr': query} if query else {}))
@@ -468,17 +515,18 @@ def test_attr_filters(clean_repos, upload, list_, filter_type):
         assert artifacts == expected, f"Wrong artifacts for {query}"
 
 
-def test_attr_filters_ambiguous(clean_repos, upload, list_):
+def test_attr_filters_ambiguous(clean_repos, upload_many, list_):
     _ = clean_repos
 
-    artifact_hashes = []
-    for i in range(5):
-        artifact_hashes.append(upload(
-            'tests/dummy_data/foobar.txt',
-            artifact_type='foo',
-            compressed=False,
-            attributes={'a': f'{i}', 'b': f'{i % 2}'}
-        ))
+    upload_many([
+        {
+            'local_path': 'tests/dummy_data/foobar.txt',
+            'type': 'foo',
+            'compressed': False,
+            'attr': {'a': f'{i}', 'b': f'{i % 2}'},
+        }
+        for i in range(5)
+    ])
 
     assert len(list_('foo', {'a': '0'})) == 1, "Wrong number of artifacts with exact match of a == 0"
     assert len(list_('foo', {'a': '1'})) == 1, "Wrong number of artifacts with exact match of a == 1"
@@ -506,42 +554,80 @@ def test_attr_filters_ambiguous(clean_repos, upload, list_):
         "Wrong number of artifacts with `biggest` on a and `ignore` on `any`"
 
 
-def test_stress(clean_repos, upload, list_, download):
+@pytest.mark.parametrize('bad_field', [
+    {'attr': 'a=b'},
+    {'env': ['A=b']},
+    {'attr': {'a': 1}},
+    {'local_path': 5},
+    {'type': ['foo']},
+    {'compressed': 'no'},
+])
+def test_upload_many_bad_field_types(clean_repos, nfs_repo_uri, nfs_repo_path, tmp_path, bad_field):
+    _ = clean_repos
+    good = {'local_path': 'tests/dummy_data/foobar.txt', 'type': 'foo', 'compressed': False}
+    manifest_path = tmp_path / 'manifest.jsonl'
+    manifest_path.write_text(json.dumps(good) + '\n' + json.dumps({**good, **bad_field}) + '\n')
+
+    runner = CliRunner(mix_stderr=False, env={'AMPM_SERVER': nfs_repo_uri})
+    result = runner.invoke(ampm.cli.cli, ['upload-many', '--manifest', str(manifest_path)])
+    assert result.exit_code != 0, 'Bad manifest accepted'
+    assert 'Line 2' in result.stderr, f'Error doesn\'t point at the bad line:\n{result.stderr}'
+    assert not (nfs_repo_path / 'metadata').exists(), 'Uploaded the manifest\'s valid lines before validating all of it'
+
+
+def test_list_without_connection_pool(clean_repos, clean_repos_now, upload_many, list_, monkeypatch):
+    _ = clean_repos
+
+    upload_many([
+        {'local_path': 'tests/dummy_data/foobar.txt', 'type': 'foo', 'compressed': False, 'attr': {'a': f'{i}'}}
+        for i in range(3)
+    ])
+    # Fetch all metadata from the server again
+    clean_repos_now()
+
+    def no_pool(*_args, **_kwargs):
+        raise AssertionError('Used the connection pool although it is disabled')
+
+    monkeypatch.setenv('AMPM_NO_CONNECTION_POOL', '1')
+    monkeypatch.setattr(ampm.repo.nfs.NFS_CONNECTION_POOL, 'get', no_pool)
+    monkeypatch.setattr(ampm.repo.nfs.NFS_CONNECTION_POOL, 'executor', no_pool)
+
+    assert len(list_('foo', {})) == 3, "Wrong number of artifacts"
+
+
+@pytest.mark.slow
+@pytest.mark.xdist_group('serial')
+def test_stress(clean_repos, upload_many, list_, download, download_direct):
     _ = clean_repos
-    artifact_hashes = []
 
     COUNT = 1000
 
-    t = time.time()
-    for i in range(COUNT):
-        if i % 100 == 0:
-            print(f'{i}/{COUNT}')
-        artifact_hashes.append(upload(
-            'tests/dummy_data/foobar.txt',
-            artifact_type='foo',
-            compressed=False
-        ))
-    upload_duration = time.time() - t
+    t = time.perf_counter()
+    artifact_hashes = upload_many([
+        {'local_path': 'tests/dummy_data/foobar.txt', 'type': 'foo', 'compressed': False}
+    ] * COUNT)
+    upload_duration = time.perf_counter() - t
     print(f'Uploaded {COUNT} artifacts in {upload_duration} seconds')
     assert upload_duration < 120, f"Uploading {COUNT} artifacts took too long"
 
-    t = time.time()
+    t = time.perf_counter()
     for i, artifact_hash in enumerate(artifact_hashes):
         if i % 100 == 0:
             print(f'{i}/{COUNT}')
-        download(f'foo:{artifact_hash}', {})
-    download_duration = time.time() - t
+        (download if i == 0 else download_direct)(f'foo:{artifact_hash}', {})
+    download_duration = time.perf_counter() - t
     print(f'Downloaded {COUNT} artifacts in {download_duration} seconds')
     assert download_duration < 100, f"Downloading {COUNT} artifacts took too long"
 
-    t = time.time()
+    t = time.perf_counter()
     artifacts = list_('foo', {})
     assert len(artifacts) == COUNT, f"Listing {COUNT} artifacts returned {len(artifacts)} instead"
-    list_duration = time.time() - t
+    list_duration = time.perf_counter() - t
     print(f'Listed {COUNT} artifacts in {list_duration} seconds')
     assert list_duration < 10, f"Listing {COUNT} artifacts took too long"
 
 
+@pytest.mark.slow
 @pytest.mark.parametrize('is_compressed', ['compressed', 'uncompressed'])
 def test_download_big_file(clean_repos, upload, download, big_file, is_compressed):
     _ = clean_repos
@@ -554,6 +640,41 @@ def test_download_big_file(clean_repos, upload, download, big_file, is_compresse
     assert_files_identical(artifact_path, big_file)
 
 
+@pytest.mark.parametrize('damage', ['truncated', 'corrupted'])
+def test_download_damaged_gz(clean_repos, upload, download_direct, nfs_repo_path: Path, tmp_path: Path, damage):
+    _ = clean_repos
+    # Random data is stored uncompressed, so the damaged part can't happen to decode as valid deflate data.
+    # Big enough for the prefetch queue to be full when decompression fails.
+    local_file = tmp_path / 'random.bin'
+    local_file.write_bytes(os.urandom(16 * 1024 * 1024))
+    artifact_hash = upload(str(local_file), artifact_type='foo', compressed=True)
+
+    remote_file = nfs_repo_path / 'artifacts' / 'foo' / artifact_hash / 'random.bin.gz'
+    with remote_file.open('r+b') as f:
+        if damage == 'truncated':
+            f.truncate(remote_file.stat().st_size // 2)
+        else:
+            f.seek(2 * 1024 * 1024)
+            f.write(b'\xff' * 256 * 1024)
+
+    errors = []
+
+    def download_damaged():
+        with pytest.raises((IOError, zlib.error)):
+            download_direct(f'foo:{artifact_hash}', {})
+        errors.append(None)
+
+    # In a thread, so a hang fails the test instead of the whole run
+    downloader = threading.Thread(target=download_damaged, daemon=True)
+    downloader.start()
+    downloader.join(timeout=60)
+    assert not downloader.is_alive(), 'Downloading a damaged artifact hung'
+    assert errors, 'Downloading a damaged artifact did not fail'
+    assert not any(t.name == 'ampm-prefetch' for t in threading.enumerate()), 'Prefetch thread kept running'
+
+
+@pytest.mark.slow
+@pytest.mark.xdist_group('serial')
 @pytest.mark.parametrize('is_compressed', ['compressed', 'uncompressed'])
 def test_parallel_download_multiple_single_file(clean_repos, upload, download, big_file, is_compressed):
     _ = clean_repos
@@ -569,20 +690,24 @@ def test_parallel_download_multiple_single_file(clean_repos, upload, download, b
         compressed=is_compressed == 'compressed'
     )
 
-    threads = []
+    # Separate processes rather than threads, `CliRunner` swaps out the process-wide stdout
+    processes = []
     for artifact_hash in (artifact1_hash, artifact2_hash):
-        def inner():
+        def inner(artifact_hash=artifact_hash):
             artifact_path = download(f'foo:{artifact_hash}', {})
             assert_files_identical(artifact_path, big_file)
 
-        t = multiprocessing.Process(target=inner)
-        threads.append(t)
-        t.start()
+        p = multiprocessing.Process(target=inner)
+        processes.append(p)
+        p.start()
 
-    for t in threads:
-        t.join(timeout=60)
+    for p in processes:
+        p.join(timeout=60)
+        assert p.exitcode == 0, f'Download process failed with exit code {p.exitcode}'
 
 
+@pytest.mark.slow
+@pytest.mark.xdist_group('serial')
 @pytest.mark.parametrize('is_compressed', ['compressed', 'uncompressed'])
 def test_parallel_download_single_single_file(clean_repos, upload, download, big_file, is_compressed):
     _ = clean_repos
@@ -593,18 +718,19 @@ def test_parallel_download_single_single_file(clean_repos, upload, download, big
         compressed=is_compressed == 'compressed'
     )
 
-    threads = []
+    processes = []
     for _ in range(5):
         def inner():
             artifact_path = download(f'foo:{artifact_hash}', {})
             assert_files_identical(artifact_path, big_file)
 
-        t = multiprocessing.Process(target=inner)
-        threads.append(t)
-        t.start()
+        p = multiprocessing.Process(target=inner)
+        processes.append(p)
+        p.start()
 
-    for t in threads:
-        t.join(timeout=60)
+    for p in processes:
+        p.join(timeout=60)
+        assert p.exitcode == 0, f'Download process failed with exit code {p.exitcode}'
 
 
 def test_offline(clean_repos, upload, list_):
@@ -626,6 +752,7 @@ def test_offline(clean_repos, upload, list_):
     assert online_list == offline_list, 'Offline listing was different than cached listing'
 
 
+@pytest.mark.xdist_group('serial')
 @pytest.mark.parametrize('is_compressed', ['compressed', 'uncompressed'])
 def test_remote_rm_file(clean_repos_now, upload, list_, remote_rm, nfs_repo_path: Path, is_compressed):
     clean_repos_now()
@@ -647,6 +774,7 @@ def test_remote_rm_file(clean_repos_now, upload, list_, remote_rm, nfs_repo_path
     assert not (nfs_repo_path / 'artifacts' / 'foo' / f'{artifact_hash}').exists(), 'Artifact file not removed'
 
 
+@pytest.mark.xdist_group('serial')
 @pytest.mark.parametrize('is_compressed', ['compressed', 'uncompressed'])
 def test_remote_rm_dir(clean_repos_now, upload, list_, remote_rm, nfs_repo_path: Path, is_compressed):
     clean_repos_now()
@@ -668,6 +796,7 @@ def test_remote_rm_dir(clean_repos_now, upload, list_, remote_rm, nfs_repo_path:
     assert not (nfs_repo_path / 'artifacts' / 'foo' / f'{artifact_hash}').exists(), 'Artifact file not removed'
 
 
+@pytest.mark.xdist_group('serial')
 @pytest.mark.parametrize('is_compressed', ['compressed', 'uncompressed'])
 def test_remote_rm_location(clean_repos_now, upload, list_, remote_rm, nfs_mount_path: Path, nfs_repo_path: Path, is_compressed):
     clean_repos_now()
@@ -691,6 +820,7 @@ def test_remote_rm_location(clean_repos_now, upload, list_, remote_rm, nfs_mount
     assert remote_path.exists(), 'Artifact file removed'
 
 
+@pytest.mark.xdist_group('serial')
 def test_remote_rm_required_arg(clean_repos, upload, list_, remote_rm):
     _ = clean_repos
 
@@ -762,6 +892,26 @@ def test_edit_multiple(clean_repos, upload, list_, edit):
     do_tests(after_remove2, {})
 
 
+def test_edit_failure_removes_temp_metadata(clean_repos, upload, edit, nfs_repo_path, monkeypatch):
+    _ = clean_repos
+
+    artifact_hash = upload(
+        'tests/dummy_data/foobar.txt',
+        artifact_type='foo',
+        compressed=False,
+    )
+
+    def failing_rename(*_args, **_kwargs):
+        raise IOError('Injected rename failure')
+
+    monkeypatch.setattr(ampm.repo.nfs.NfsConnection, 'rename', failing_rename)
+    with pytest.raises(IOError, match='Injected rename failure'):
+        edit(f'foo:{artifact_hash}', {'abc': 'def'})
+
+    leftovers = [p.name for p in (nfs_repo_path / 'metadata' / 'foo').iterdir() if '.toml.tmp' in p.name]
+    assert leftovers == [], 'Failed edit left its temporary metadata file behind'
+
+
 def test_edit_try_override_static_attr(clean_repos, upload, list_, edit):
     _ = clean_repos
 
@@ -1,60 +1,67 @@
-import random
-import shutil
+import hashlib
+import multiprocessing
+import os
+import threading
+import time
 import pytest
+import ampm.repo.nfs
 from pathlib import Path
+from pyNfsClient import NF3REG, NF3LNK
 from ampm.repo.base import NiceTrySagi
-from ampm.repo.nfs import NfsConnection, NfsRepo
-from ampm.utils import randbytes
+from ampm.repo.nfs import NfsConnection, NfsRepo, _PathLru, _prefetch
 
 
-def test_operations(clean_repos, nfs_repo: NfsRepo, nfs_mount_path: Path):
+def test_operations(clean_repos, nfs_repo: NfsRepo, nfs_mount_path: Path, tmp_path: Path):
     _ = clean_repos
     nfs = NfsConnection(nfs_repo.host, nfs_repo.mount_path)
 
     with nfs.connected():
-        ident = f'ampm_tests_{randbytes(8).hex()}'
-        local_path = Path(f'/tmp/{ident}')
+        local_path = tmp_path
         remote_path = Path(f'nfs_tests')
-        try:
-            # Upload
-            local_path.mkdir(parents=True, exist_ok=True)
-            (local_path / 'foo.txt').write_text('foo bar')
-            nfs.upload(local_path / 'foo.txt', str(remote_path / 'foo.txt'))
-            assert (nfs_mount_path / remote_path / 'foo.txt').is_file(), 'Uploaded file missing'
-            assert (nfs_mount_path / remote_path / 'foo.txt').read_text() == 'foo bar', 'Uploaded file content mismatch'
-
-            # List
-            assert sorted(list(nfs.list_dir(str(remote_path)))) == [b'.', b'..', b'foo.txt'], \
-                'List dir mismatch after initial upload'
-
-            # Download
-            nfs.download(local_path / 'foo2.txt', str(remote_path / 'foo.txt'))
-            assert (local_path / 'foo2.txt').is_file(), 'Downloaded file missing'
-            assert (local_path / 'foo2.txt').read_text() == 'foo bar', 'Downloaded file content mismatch'
-
-            # Rename
-            nfs.rename(str(remote_path / 'foo.txt'), str(remote_path / 'foo2.txt'))
-            assert sorted(list(nfs.list_dir(str(remote_path)))) == [b'.', b'..', b'foo2.txt'], \
-                'List dir mismatch after rename'
-
-            # Symlink
-            nfs.symlink(str(nfs_mount_path / remote_path / 'foo2.txt'), str(remote_path / 'foo3.txt'))
-            assert sorted(list(nfs.list_dir(str(remote_path)))) == [b'.', b'..', b'foo2.txt', b'foo3.txt'], \
-                'List dir mismatch after file symlink'
-            nfs.symlink(str(nfs_mount_path / remote_path / '..'), str(remote_path / 'foo4.txt'))
-            assert sorted(list(nfs.list_dir(str(remote_path)))) == [
-                b'.', b'..', b'foo2.txt', b'foo3.txt', b'foo4.txt'
-            ], 'List dir mismatch after relative symlink'
-            nfs.symlink('/a/b', str(remote_path / 'foo5.txt'))
-            assert sorted(list(nfs.list_dir(str(remote_path)))) == [
-                b'.', b'..', b'foo2.txt', b'foo3.txt', b'foo4.txt', b'foo5.txt'
-            ], 'List dir mismatch after absolute symlink'
-
-            # Readlink
-            assert nfs.readlink(str(remote_path / 'foo3.txt')) \
-                   == str(nfs_mount_path / remote_path / 'foo2.txt').encode(), 'Readlink mismatch'
-        finally:
-            shutil.rmtree(local_path, ignore_errors=True)
+
+        # Upload
+        (local_path / 'foo.txt').write_text('foo bar')
+        nfs.upload(local_path / 'foo.txt', str(remote_path / 'foo.txt'))
+        assert (nfs_mount_path / remote_path / 'foo.txt').is_file(), 'Uploaded file missing'
+        assert (nfs_mount_path / remote_path / 'foo.txt').read_text() == 'foo bar', 'Uploaded file content mismatch'
+
+        # List
+        assert sorted(list(nfs.list_dir(str(remote_path)))) == [b'.', b'..', b'foo.txt'], \
+            'List dir mismatch after initial upload'
+
+        # Download
+        nfs.download(local_path / 'foo2.txt', str(remote_path / 'foo.txt'))
+        assert (local_path / 'foo2.txt').is_file(), 'Downloaded file missing'
+        assert (local_path / 'foo2.txt').read_text() == 'foo bar', 'Downloaded file content mismatch'
+
+        # Rename
+        nfs.rename(str(remote_path / 'foo.txt'), str(remote_path / 'foo2.txt'))
+        assert sorted(list(nfs.list_dir(str(remote_path)))) == [b'.', b'..', b'foo2.txt'], \
+            'List dir mismatch after rename'
+
+        # Symlink
+        nfs.symlink(str(nfs_mount_path / remote_path / 'foo2.txt'), str(remote_path / 'foo3.txt'))
+        assert sorted(list(nfs.list_dir(str(remote_path)))) == [b'.', b'..', b'foo2.txt', b'foo3.txt'], \
+            'List dir mismatch after file symlink'
+        nfs.symlink(str(nfs_mount_path / remote_path / '..'), str(remote_path / 'foo4.txt'))
+        assert sorted(list(nfs.list_dir(str(remote_path)))) == [
+            b'.', b'..', b'foo2.txt', b'foo3.txt', b'foo4.txt'
+        ], 'List dir mismatch after relative symlink'
+        nfs.symlink('/a/b', str(remote_path / 'foo5.txt'))
+        assert sorted(list(nfs.list_dir(str(remote_path)))) == [
+            b'.', b'..', b'foo2.txt', b'foo3.txt', b'foo4.txt', b'foo5.txt'
+        ], 'List dir mismatch after absolute symlink'
+        expected_types = {b'foo2.txt': NF3REG, b'foo3.txt': NF3LNK, b'foo4.txt': NF3LNK, b'foo5.txt': NF3LNK}
+        entries = dict(nfs.list_dir(str(remote_path), with_attrs=True))
+        assert sorted(entries.keys()) == [b'.', b'..', b'foo2.txt', b'foo3.txt', b'foo4.txt', b'foo5.txt'], \
+            'List dir with attributes mismatch'
+        for name, expected_type in expected_types.items():
+            # Attributes are only available if the server supports READDIRPLUS
+            assert entries[name] is None or entries[name]['type'] == expected_type, 'List dir attributes mismatch'
+
+        # Readlink
+        assert nfs.readlink(str(remote_path / 'foo3.txt')) \
+               == str(nfs_mount_path / remote_path / 'foo2.txt').encode(), 'Readlink mismatch'
 
 
 def test_path_traversal(clean_repos, nfs_repo: NfsRepo, nfs_mount_path: Path):
@@ -120,3 +127,228 @@ def test_big_readdir(clean_repos, nfs_repo: NfsRepo, nfs_mount_path: Path):
         assert list(sorted(list(nfs.list_dir('')))) == expected_files1
 
         assert list(sorted(list(nfs.walk_files('')))) == expected_files2
+
+
+def test_download_from_local_mount(clean_repos, nfs_repo: NfsRepo, nfs_mount_path: Path, tmp_path: Path):
+    _ = clean_repos
+    nfs = NfsConnection(nfs_repo.host, nfs_repo.mount_path)
+    nfs.local_mount = str(nfs_mount_path)
+
+    (nfs_mount_path / 'local_dir').mkdir()
+    (nfs_mount_path / 'local_dir' / 'foo.txt').write_text('foo bar')
+    (nfs_mount_path / 'local_dir' / 'nested').mkdir()
+    (nfs_mount_path / 'local_dir' / 'nested' / 'boo.txt').write_text('boo')
+
+    def no_rpc_reads(*_args, **_kwargs):
+        raise AssertionError('Read over RPC instead of copying from the local mount')
+
+    nfs.read_stream = no_rpc_reads
+    with nfs.connected():
+        file_hash = nfs.download(tmp_path / 'foo.txt', 'local_dir/foo.txt')
+        assert (tmp_path / 'foo.txt').read_text() == 'foo bar', 'Downloaded file content mismatch'
+        assert file_hash == hashlib.sha256(b'foo bar').hexdigest(), 'Downloaded file hash mismatch'
+
+        nfs.download(tmp_path / 'dir', 'local_dir')
+        assert (tmp_path / 'dir' / 'nested' / 'boo.txt').read_text() == 'boo', 'Downloaded dir content mismatch'
+
+
+@pytest.mark.parametrize('local_copy', ['different_file', 'symlinked_dir'])
+def test_download_from_local_mount_falls_back(clean_repos, nfs_repo: NfsRepo, nfs_mount_path: Path, tmp_path: Path,
+                                              local_copy):
+    _ = clean_repos
+    (nfs_mount_path / 'local_dir').mkdir()
+    (nfs_mount_path / 'local_dir' / 'foo.txt').write_text('foo bar')
+
+    local_mount = tmp_path / 'local_mount'
+    local_mount.mkdir()
+    if local_copy == 'different_file':
+        # Same size, but not the file on the server
+        (local_mount / 'local_dir').mkdir()
+        (local_mount / 'local_dir' / 'foo.txt').write_text('not foo')
+    else:
+        # The right file, but reached through a symlink that could point anywhere
+        (local_mount / 'local_dir').symlink_to(nfs_mount_path / 'local_dir')
+
+    nfs = NfsConnection(nfs_repo.host, nfs_repo.mount_path)
+    nfs.local_mount = str(local_mount)
+    read_stream = nfs.read_stream
+    rpc_reads = []
+
+    def counting_read_stream(*args, **kwargs):
+        rpc_reads.append(args)
+        return read_stream(*args, **kwargs)
+
+    nfs.read_stream = counting_read_stream
+    with nfs.connected():
+        nfs.download(tmp_path / 'foo.txt', 'local_dir/foo.txt')
+    assert (tmp_path / 'foo.txt').read_text() == 'foo bar', 'Downloaded file content mismatch'
+    assert rpc_reads, 'Copied from the local mount instead of reading over RPC'
+
+
+def test_parallel_download_without_connection_pool(clean_repos, nfs_repo: NfsRepo, nfs_mount_path: Path,
+                                                   tmp_path: Path, monkeypatch):
+    _ = clean_repos
+    monkeypatch.setenv('AMPM_NO_CONNECTION_POOL', '1')
+
+    def no_pool(*_args, **_kwargs):
+        raise AssertionError('Used the connection pool although it is disabled')
+
+    monkeypatch.setattr(ampm.repo.nfs.NFS_CONNECTION_POOL, 'get', no_pool)
+    monkeypatch.setattr(ampm.repo.nfs.NFS_CONNECTION_POOL, 'executor', no_pool)
+
+    (nfs_mount_path / 'dir').mkdir()
+    for i in range(4):
+        (nfs_mount_path / 'dir' / f'{i}.txt').write_text(str(i))
+
+    nfs = NfsConnection(nfs_repo.host, nfs_repo.mount_path)
+    with nfs.connected():
+        nfs.download(tmp_path / 'dir', 'dir', parallel=True)
+    for i in range(4):
+        assert (tmp_path / 'dir' / f'{i}.txt').read_text() == str(i), 'Downloaded dir content mismatch'
+
+
+def test_path_lru():
+    lru = _PathLru(max_size=3)
+    lru.put(('a', 'b', 'c'), 1)
+    lru.put(('a', 'b'), 2)
+    lru.put(('a', 'x'), 3)
+
+    lru.pop_subtree(('a', 'b'))
+    assert lru.get(('a', 'b', 'c')) is None and lru.get(('a', 'b')) is None, 'Subtree not dropped'
+    assert lru.get(('a', 'x')) == 3, 'Dropped a path outside the subtree'
+
+    lru.put(('d',), 4)
+    lru.put(('e',), 5)
+    lru.put(('f',), 6)
+    assert lru.get(('a', 'x')) is None, 'Least recently used path not evicted'
+    lru.pop_subtree(('a',))
+    assert [lru.get((name,)) for name in 'def'] == [4, 5, 6]
+    assert ('a',) not in lru._children, 'Evicted path still indexed'
+
+
+def test_read_sees_changes_by_other_clients(clean_repos, nfs_repo: NfsRepo, nfs_mount_path: Path):
+    _ = clean_repos
+    nfs = NfsConnection(nfs_repo.host, nfs_repo.mount_path)
+
+    # Old enough for the missing file to be cached
+    os.utime(nfs_mount_path, (time.time() - 60, time.time() - 60))
+
+    with nfs.connected():
+        with pytest.raises(IOError):
+            nfs.read('later.txt')
+        with pytest.raises(IOError, match='cached'):
+            nfs.read('later.txt')
+        # Created by another client
+        (nfs_mount_path / 'later.txt').write_text('later')
+        assert bytes(nfs.read('later.txt')) == b'later', 'Missing file cached after it was created'
+
+        (nfs_mount_path / 'grow.txt').write_text('abc')
+        assert bytes(nfs.read('grow.txt')) == b'abc'
+        # Rewritten by another client
+        (nfs_mount_path / 'grow.txt').write_text('abcdef')
+        assert bytes(nfs.read('grow.txt')) == b'abcdef', 'Read with a cached file size'
+
+
+@pytest.mark.parametrize('replacement', [None, 'new', 'newer', 'n'])
+def test_read_retry_after_failure(clean_repos, nfs_repo: NfsRepo, nfs_mount_path: Path, replacement):
+    _ = clean_repos
+    (nfs_mount_path / 'replaced.txt').write_text('old')
+
+    nfs = NfsConnection(nfs_repo.host, nfs_repo.mount_path)
+    read_pipelined = nfs._read_pipelined
+
+    def replace_then_fail(*_args, **_kwargs):
+        if replacement is not None:
+            # A different file (with a new handle) in its place, of the same or a different length
+            (nfs_mount_path / 'replacement.txt').write_text(replacement)
+            (nfs_mount_path / 'replacement.txt').replace(nfs_mount_path / 'replaced.txt')
+        nfs._read_pipelined = read_pipelined
+        raise IOError('Injected read failure')
+        yield
+
+    nfs._read_pipelined = replace_then_fail
+    with nfs.connected():
+        if replacement is None:
+            assert bytes(nfs.read('replaced.txt')) == b'old', 'Retried read returned wrong contents'
+        else:
+            with pytest.raises(IOError, match='replaced while being read'):
+                nfs.read('replaced.txt')
+
+
+def test_upload_truncated_file(clean_repos, nfs_repo: NfsRepo, tmp_path: Path):
+    _ = clean_repos
+    local_file = tmp_path / 'shrinking.bin'
+    local_file.write_bytes(b'x' * 64 * 1024)
+
+    nfs = NfsConnection(nfs_repo.host, nfs_repo.mount_path)
+    write_stream = nfs.write_stream
+
+    def truncating_write_stream(contents_gen, *args, **kwargs):
+        def truncate_after_first_chunk():
+            for i, chunk in enumerate(contents_gen):
+                if i == 0:
+                    os.truncate(local_file, 1000)
+                yield chunk
+        return write_stream(truncate_after_first_chunk(), *args, **kwargs)
+
+    nfs.write_stream = truncating_write_stream
+    with nfs.connected():
+        with pytest.raises(IOError, match='truncated'):
+            nfs._upload_file(local_file, 'shrinking.bin', chunk_size=1024)
+
+
+def test_forked_child_gets_own_connection(clean_repos, nfs_repo: NfsRepo, nfs_mount_path: Path):
+    _ = clean_repos
+    (nfs_mount_path / 'foo.txt').write_text('foo bar')
+    pool = ampm.repo.nfs.NFS_CONNECTION_POOL
+
+    with nfs_repo.nfs.connected():
+        parent_nfs = nfs_repo.nfs
+        assert list(parent_nfs.walk_files('')) == ['/foo.txt']
+
+        def child():
+            # Neither the parent's connection nor the pool's lock (held while forking) may be used here
+            assert nfs_repo.nfs is not parent_nfs, 'Child reused the parent connection'
+            with nfs_repo.nfs.connected():
+                assert list(nfs_repo.nfs.walk_files('')) == ['/foo.txt']
+
+        process = multiprocessing.get_context('fork').Process(target=child)
+        with pool._lock:
+            process.start()
+        process.join(30)
+        if process.is_alive():
+            process.kill()
+        assert process.exitcode == 0, 'Child failed to use its own connection'
+
+        # The parent still uses its connection
+        assert nfs_repo.nfs is parent_nfs
+        assert list(parent_nfs.walk_files('')) == ['/foo.txt']
+
+
+@pytest.mark.parametrize('producer_state', ['blocked_on_chunk', 'blocked_on_end', 'blocked_on_error'])
+def test_prefetch_consumer_stops_early(producer_state):
+    source_closed = threading.Event()
+
+    def source():
+        try:
+            yield from [b'a', b'b', b'c']
+            if producer_state == 'blocked_on_chunk':
+                yield b'd'
+            elif producer_state == 'blocked_on_error':
+                raise IOError('Source failed')
+        finally:
+            source_closed.set()
+
+    def consume():
+        for _chunk in _prefetch(source(), depth=2):
+            # Let the producer fill the queue and block on the next put
+            time.sleep(0.5)
+            raise RuntimeError('Consumer failed')
+
+    errors = []
+    consumer = threading.Thread(target=lambda: errors.append(pytest.raises(RuntimeError, consume)), daemon=True)
+    consumer.start()
+    consumer.join(timeout=10)
+    assert not consumer.is_alive(), 'Stopping the consumer waited forever for the producer'
+    assert len(errors) == 1, 'Consumer error was not raised'
+    assert source_closed.is_set(), 'Source was not closed after the consumer stopped'